@@ -36,6 +36,11 @@ class Example(Service):
         else:
             return Cursor(list(range(n, n+5)), None, None)
 
+    @rpc()
+    def hello_stream(self, n: int = 5):
+        for i in range(n):
+            yield "Hello, {}!".format(i)
+
     @rpc(raw_args=True)
     def echo(self, args):
         return args
@@ -0,0 +1,49 @@
+import socket
+import threading
+
+import pytest
+
+
+class FlakyServer(threading.Thread):
+    """ answers the first request on each connection, then reads the next and hangs up """
+    def __init__(self):
+        threading.Thread.__init__(self, daemon=True)
+        self.sock = socket.socket()
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(8)
+        self.requests = []
+        self.url = 'http://127.0.0.1:{}/'.format(self.sock.getsockname()[1])
+
+    def run(self):
+        while True:
+            try:
+                conn, addr = self.sock.accept()
+            except OSError:
+                return
+            with conn, conn.makefile('rb') as fh:
+                for answer in (True, False):
+                    line = fh.readline()
+                    if not line:
+                        break
+                    length = 0
+                    while True:
+                        header = fh.readline()
+                        if header in (b'\r\n', b''):
+                            break
+                        name, _, value = header.decode('latin-1').partition(':')
+                        if name.lower() == 'content-length':
+                            length = int(value)
+                    fh.read(length)
+                    self.requests.append(line.split()[0].decode('ascii'))
+                    if answer:
+                        conn.sendall(b'HTTP/1.1 200 OK\r\nContent-Length: 2\r\n\r\nok')
+
+    def close(self):
+        self.sock.close()
+
+@pytest.fixture
+def flaky_server():
+    s = FlakyServer()
+    s.start()
+    yield s
+    s.close()
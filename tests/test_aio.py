@@ -0,0 +1,136 @@
+import asyncio
+import http.client
+import urllib.error
+
+import pytest
+
+from trpc import aio, wsgi
+from trpc.server import App, Cursor, Service, rpc
+
+
+class Handler(wsgi.KeepAliveRequestHandler):
+    def log_request(self, code='-', size='-'):
+        pass
+
+def plain(environ, start_response):
+    path = environ['PATH_INFO']
+    method = environ['REQUEST_METHOD']
+    if path == '/chunked':
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return (part for part in [b'one ', b'', b'two ', b'x' * 70000])
+    elif path in ('/see-other', '/temporary'):
+        status = '303 See Other' if path == '/see-other' else '307 Temporary Redirect'
+        start_response(status, [('Location', '/echo'), ('Content-Length', '0')])
+        return []
+    elif path == '/loop':
+        start_response('302 Found', [('Location', '/loop'), ('Content-Length', '0')])
+        return []
+    elif path == '/echo':
+        data = environ['wsgi.input'].read(int(environ.get('CONTENT_LENGTH') or 0))
+        body = method.encode('ascii') + b' ' + data
+        start_response('200 OK', [('Content-Type', 'text/plain'), ('Content-Length', str(len(body)))])
+        return [body]
+    start_response('404 Not Found', [('Content-Type', 'text/plain'), ('Content-Length', '4')])
+    return [b'nope']
+
+class Example(Service):
+    @rpc()
+    def hello(self, name: str) -> str:
+        return "Hello, {}!".format(name)
+
+    @rpc()
+    def count(self, n: int):
+        return Cursor(list(range(n)), None, None)
+
+@pytest.fixture
+def server():
+    s = wsgi.ThreadPoolWSGIServer(plain, host='127.0.0.1', threads=2, read_timeout=5, request_handler=Handler)
+    s.start()
+    yield s
+    s.stop()
+
+@pytest.fixture
+def app_server():
+    app = App('app', {'Example': Example})
+    s = wsgi.ThreadPoolWSGIServer(app, host='127.0.0.1', threads=4, read_timeout=5, request_handler=Handler)
+    s.start()
+    yield s
+    s.stop()
+
+def url(server, path):
+    host, port = server.server.server_address[:2]
+    return 'http://{}:{}{}'.format(host, port, path)
+
+def run(coro):
+    return asyncio.run(asyncio.wait_for(coro, 10))
+
+def test_keep_alive_and_chunked(server):
+    async def main():
+        pool = aio.ConnectionPool(timeout=5)
+        first = await pool.urlopen('GET', url(server, '/chunked'))
+        conns = [c for cs in pool.idle.values() for c in cs]
+        second = await pool.urlopen('POST', url(server, '/echo'), b'hello')
+        again = [c for cs in pool.idle.values() for c in cs]
+        await pool.close()
+        return first.body, second.body, conns, again
+    first, second, conns, again = run(main())
+    assert first == b'one two ' + b'x' * 70000
+    assert second == b'POST hello'
+    assert len(conns) == 1 and again == conns
+
+def test_redirects(server):
+    async def main():
+        pool = aio.ConnectionPool(timeout=5, max_redirects=3)
+        see_other = await pool.urlopen('POST', url(server, '/see-other'), b'body', {'Content-Type': 'text/plain'})
+        temporary = await pool.urlopen('POST', url(server, '/temporary'), b'body', {'Content-Type': 'text/plain'})
+        try:
+            with pytest.raises(urllib.error.HTTPError) as loop:
+                await pool.urlopen('GET', url(server, '/loop'))
+            with pytest.raises(urllib.error.HTTPError) as missing:
+                await pool.urlopen('GET', url(server, '/missing'))
+        finally:
+            await pool.close()
+        return see_other, temporary, loop.value, missing.value
+    see_other, temporary, loop, missing = run(main())
+    assert see_other.body == b'GET ' and see_other.url.endswith('/echo')
+    assert temporary.body == b'POST body'
+    assert loop.code == 302
+    assert missing.code == 404 and missing.read() == b'nope'
+
+def test_connect_timeout(monkeypatch):
+    async def blackhole(*args, **kwargs):
+        await asyncio.sleep(60)
+    monkeypatch.setattr(asyncio, 'open_connection', blackhole)
+    async def main():
+        pool = aio.ConnectionPool(timeout=0.1)
+        with pytest.raises(asyncio.TimeoutError):
+            await pool.urlopen('GET', 'http://192.0.2.1/')
+    run(main())
+
+def test_get_retried_post_not(flaky_server):
+    async def main():
+        pool = aio.ConnectionPool(timeout=5)
+        get = [await pool.urlopen('GET', flaky_server.url) for n in range(2)]
+        await pool.close()
+        pool = aio.ConnectionPool(timeout=5)
+        await pool.urlopen('POST', flaky_server.url, b'{}')
+        with pytest.raises((ConnectionError, asyncio.IncompleteReadError)):
+            await pool.urlopen('POST', flaky_server.url, b'{}')
+        await pool.close()
+        return get
+    get = run(main())
+    assert [r.body for r in get] == [b'ok', b'ok']
+    assert flaky_server.requests == ['GET', 'GET', 'GET', 'POST', 'POST']
+
+def test_api(app_server):
+    async def main():
+        api = await aio.open(url(app_server, '/'))
+        hello = await api.Example.hello(name="async")
+        names = await aio.gather(*[api.Example.hello(name=str(n)) for n in range(20)], limit=5)
+        count = [n async for n in api.Example.count(n=5)]
+        await api._session.close()
+        return hello, names, count
+    hello, names, count = run(main())
+    assert hello == "Hello, async!"
+    assert names == ["Hello, {}!".format(n) for n in range(20)]
+    assert count == [0, 1, 2, 3, 4]
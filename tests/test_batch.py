@@ -0,0 +1,106 @@
+import threading
+import urllib.error
+
+import pytest
+
+from trpc import client, wire, wsgi
+from trpc.server import App, Service, rpc
+
+
+class Handler(wsgi.KeepAliveRequestHandler):
+    def log_request(self, code='-', size='-'):
+        pass
+
+class Example(Service):
+    threads = set()
+
+    @rpc()
+    def hello(self, name: str) -> str:
+        Example.threads.add(threading.get_ident())
+        return "Hello, {}!".format(name)
+
+    @rpc()
+    def add(self, a: int, b: int) -> int:
+        return a + b
+
+    @rpc()
+    def fail(self):
+        raise wire.HTTPResponse('409 nope', [], [b'not today'])
+
+@pytest.fixture(scope='module')
+def server():
+    s = wsgi.ThreadPoolWSGIServer(App('app', {'Example': Example}), host='127.0.0.1', threads=2, read_timeout=5, request_handler=Handler)
+    s.start()
+    yield s
+    s.stop()
+
+@pytest.fixture
+def api(server):
+    host, port = server.server.server_address[:2]
+    return client.open('http://{}:{}/'.format(host, port))
+
+def post(app, batch):
+    content_type, data = batch.encode()
+    request = wire.HTTPRequest('POST', '/', {}, {}, content_type, data, None)
+    return app.handle_request(request)
+
+def test_batch_round_trip():
+    batch = wire.Batch([], parallel=True)
+    batch.add('/Example/add', None, {'a': 1, 'b': 2})
+    out = wire.decode_bytes(*reversed(batch.encode()))
+    assert isinstance(out, wire.Batch)
+    assert out.parallel is True
+    assert out.calls == [{'path': '/Example/add', 'params': {}, 'args': {'a': 1, 'b': 2}}]
+
+def test_batch_in_order():
+    app = App('app', {'Example': Example})
+    batch = wire.Batch([])
+    for n in range(5):
+        batch.add('/Example/add', None, {'a': n, 'b': 10})
+    batch.add('/Example/hello', None, {'name': 'batch'})
+    result = post(app, batch)
+    assert isinstance(result, wire.BatchResult)
+    values = [wire.decode_object(r) for r in result.results]
+    assert [v.value for v in values] == [10, 11, 12, 13, 14, "Hello, batch!"]
+
+def test_batch_errors_are_per_call():
+    app = App('app', {'Example': Example})
+    batch = wire.Batch([])
+    batch.add('/Example/add', None, {'a': 1, 'b': 1})
+    batch.add('/Example/fail', None, {})
+    batch.add('/Missing/add', None, {})
+    batch.add('/', None, {})
+    results = post(app, batch).enumerate()
+    assert results[0].value == 2
+    assert isinstance(results[1], wire.Error) and results[1].status.startswith('409')
+    assert results[1].message == 'not today'
+    assert isinstance(results[2], wire.Error) and results[2].status.startswith('404')
+    assert isinstance(results[3], wire.Error) and results[3].status.startswith('400')
+
+def test_parallel_batch():
+    app = App('app', {'Example': Example})
+    Example.threads = set()
+    batch = wire.Batch([], parallel=True)
+    for n in range(20):
+        batch.add('/Example/hello', None, {'name': str(n)})
+    values = [r.value for r in post(app, batch).enumerate()]
+    assert values == ["Hello, {}!".format(n) for n in range(20)]
+    assert threading.get_ident() not in Example.threads
+
+def test_client_batch(api):
+    with client.Batch(api) as batch:
+        a = batch.call(api.Example.hello, name="a")
+        b = batch.call(api.Example.add, a=1, b=2)
+        c = batch.call(api.Example.fail)
+    assert a.result() == "Hello, a!"
+    assert b.result() == 3
+    with pytest.raises(urllib.error.HTTPError) as e:
+        c.result()
+    assert e.value.code == 409
+
+def test_client_batch_flushes_on_result(api):
+    batch = client.Batch(api, parallel=True)
+    calls = [batch.call(api.Example.add, a=n, b=n) for n in range(4)]
+    assert calls[2].result() == 4
+    assert batch.pending == []
+    assert [c.result() for c in calls] == [0, 2, 4, 6]
@@ -0,0 +1,41 @@
+import io
+
+import pytest
+
+from trpc.cli import read_batches
+
+
+class Lines(io.StringIO):
+    """ records how many lines have been read """
+    def __init__(self, text):
+        io.StringIO.__init__(self, text)
+        self.count = 0
+
+    def __next__(self):
+        self.count += 1
+        return io.StringIO.__next__(self)
+
+def test_lines_in_batches():
+    fh = Lines('{"a": 1}\n\n{"a": 2}\n  \n{"a": 3}\n4\n"five"\n')
+    batches = read_batches(fh, 2)
+    assert next(batches) == [{"a": 1}, {"a": 2}]
+    assert fh.count == 3 # the rest of the input is still unread
+    assert list(batches) == [[{"a": 3}, 4], ["five"]]
+
+def test_lines_exact_multiple():
+    fh = Lines('1\n2\n3\n4\n')
+    assert list(read_batches(fh, 2)) == [[1, 2], [3, 4]]
+
+def test_list():
+    fh = Lines('\n  [1, 2,\n 3, {"a": [4]},\n 5]\n')
+    assert list(read_batches(fh, 2)) == [[1, 2], [3, {"a": [4]}], [5]]
+
+@pytest.mark.parametrize('text', ['', '\n  \n', '[]'])
+def test_empty(text):
+    assert list(read_batches(Lines(text), 10)) == []
+
+def test_bad_line():
+    batches = read_batches(Lines('1\n2\n{\n'), 1)
+    assert next(batches) == [1]
+    with pytest.raises(ValueError):
+        list(batches)
@@ -0,0 +1,76 @@
+import http.client
+
+import pytest
+
+from trpc import client, wire, wsgi
+from trpc.server import App, Service, rpc
+
+
+def fetch(pool, method, url, body=None):
+    fh = pool.open(method, url, body)
+    try:
+        return fh.read()
+    finally:
+        fh.close()
+
+def test_get_retried_on_a_new_connection(flaky_server):
+    pool = client.ConnectionPool(timeout=5)
+    assert fetch(pool, 'GET', flaky_server.url) == b'ok'
+    assert fetch(pool, 'GET', flaky_server.url) == b'ok'
+    assert flaky_server.requests == ['GET', 'GET', 'GET']
+    pool.close()
+
+def test_post_not_retried(flaky_server):
+    pool = client.ConnectionPool(timeout=5)
+    assert fetch(pool, 'POST', flaky_server.url, b'{}') == b'ok'
+    with pytest.raises((ConnectionError, http.client.BadStatusLine)):
+        fetch(pool, 'POST', flaky_server.url, b'{}')
+    assert flaky_server.requests == ['POST', 'POST']
+    pool.close()
+
+def test_negotiated_per_server():
+    session = client.Session()
+    session.learn('http://a:1/x/', 'application/trpc+msgpack; q=1', 'gzip')
+    session.learn('http://b:2/', wire.CONTENT_TYPE + '; lines=1', None)
+    if wire.codec_for('application/trpc+msgpack'):
+        assert session.negotiated('http://a:1/y') == ('application/trpc+msgpack', 'gzip')
+    else:
+        assert session.negotiated('http://a:1/y') == (wire.CONTENT_TYPE, 'gzip')
+    assert session.negotiated('http://b:2/y') == (wire.CONTENT_TYPE, None)
+    assert session.negotiated('http://c:3/') == (wire.CONTENT_TYPE, None)
+    session.learn('http://a:1/z', None, None)
+    assert session.negotiated('http://A:1/')[1] == 'gzip'
+
+class Handler(wsgi.KeepAliveRequestHandler):
+    def log_request(self, code='-', size='-'):
+        pass
+
+class Example(Service):
+    @rpc()
+    def echo(self, value):
+        return value
+
+def test_request_bodies_follow_each_server():
+    pytest.importorskip('msgpack')
+    app = App('app', {'Example': Example})
+    seen = []
+    def json_only(environ, start_response):
+        if environ['REQUEST_METHOD'] == 'POST':
+            seen.append(environ['CONTENT_TYPE'])
+        environ['HTTP_ACCEPT'] = wire.CONTENT_TYPE
+        return app(environ, start_response)
+    servers = [wsgi.ThreadPoolWSGIServer(a, host='127.0.0.1', threads=2, request_handler=Handler) for a in (app, json_only)]
+    for s in servers:
+        s.start()
+    try:
+        session = client.Session()
+        msgpack_api = client.open(servers[0].url, session=session)
+        json_api = client.open(servers[1].url, session=session)
+        assert msgpack_api.Example.echo(value=1) == 1
+        assert json_api.Example.echo(value=2) == 2
+        assert msgpack_api.Example.echo(value=3) == 3
+        assert json_api.Example.echo(value=4) == 4
+    finally:
+        for s in servers:
+            s.stop()
+    assert [wire.codec_for(c).content_type for c in seen] == [wire.CONTENT_TYPE] * 2
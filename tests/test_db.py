@@ -0,0 +1,164 @@
+import warnings
+
+import pytest
+
+peewee = pytest.importorskip('peewee')
+
+from trpc import wire
+from trpc.server import App
+from trpc import db
+from trpc.db import ModelCache, PeeweeEndpoint, Selector, SelectorError, UnindexedSelectorWarning, parse_selector
+
+
+database = peewee.SqliteDatabase(':memory:')
+
+class Person(peewee.Model):
+    name = peewee.CharField(index=True)
+    age = peewee.IntegerField(null=True)
+
+    class Meta:
+        database = database
+
+NAMES = ["bob", "bobby", "Bob", "bo", "alice", "b퟿", "b퟿z", "b",
+    "b\U0010FFFF", "b\U0010FFFFz", "c"]
+
+@pytest.fixture(scope='module', autouse=True)
+def people():
+    database.connect()
+    database.create_tables([Person])
+    Person.insert_many([(n, i) for i, n in enumerate(NAMES)], fields=[Person.name, Person.age]).execute()
+    yield
+    database.close()
+
+def sql(obj):
+    expr = Selector.parse(obj).compile(Person._meta.fields)
+    return Person.select(Person.name).where(expr).sql()
+
+def names(obj):
+    expr = Selector.parse(obj).compile(Person._meta.fields)
+    query = Person.select(Person.name).order_by(Person.id)
+    if expr is not None:
+        query = query.where(expr)
+    return [p.name for p in query]
+
+def test_compile():
+    assert sql({"name": "bob"})[1] == ["bob"]
+    assert 'IS NULL' in sql({"age": None})[0]
+    assert 'IS NOT NULL' in sql({"age": {"!=": None}})[0]
+    text, params = sql({"name": {"in": ["a", "b"]}, "age": {">=": 1, "<": 5}})
+    assert ' IN ' in text and ' AND ' in text
+    assert params == ["a", "b", 1, 5]
+    text, params = sql({"$or": [{"name": "a"}, {"$not": {"age": 3}}]})
+    assert ' OR ' in text and 'NOT' in text
+
+def test_prefix_is_a_range():
+    text, params = sql({"name": {"prefix": "bo"}})
+    assert 'LIKE' not in text
+    assert params == ["bo", "bp"]
+    assert names({"name": {"prefix": "bo"}}) == ["bob", "bobby", "bo"]
+    assert names({"name": {"prefix": "bob"}}) == ["bob", "bobby"]
+
+def test_prefix_empty():
+    assert names({"name": {"prefix": ""}}) == NAMES
+
+@pytest.mark.parametrize('prefix, expected', [
+    ("b퟿", ["b퟿", "b퟿z"]),
+    ("b\U0010FFFF", ["b\U0010FFFF", "b\U0010FFFFz"]),
+])
+def test_prefix_without_successor(prefix, expected):
+    assert names({"name": {"prefix": prefix}}) == expected
+
+def test_empty_selectors():
+    assert names({"$and": []}) == NAMES
+    assert names([]) == NAMES
+
+@pytest.mark.parametrize('obj', [
+    "bob",
+    {"$xor": []},
+    {"$or": {}},
+    {"name": {"~": "b"}},
+    {"name": {"in": "b"}},
+    {"name": {"prefix": 1}},
+])
+def test_parse_errors(obj):
+    with pytest.raises(SelectorError):
+        Selector.parse(obj)
+
+def test_unknown_field():
+    with pytest.raises(SelectorError):
+        Selector.parse({"nope": 1}).compile(Person._meta.fields)
+
+def test_indexed():
+    indexes = {"name"}
+    assert Selector.parse({"name": "a", "age": 1}).indexed(indexes)
+    assert not Selector.parse({"age": 1}).indexed(indexes)
+    assert not Selector.parse({"$or": [{"name": "a"}, {"age": 1}]}).indexed(indexes)
+    assert not Selector.parse({"name": {"!=": "a"}}).indexed(indexes)
+
+def test_parse_selector():
+    assert parse_selector('{"name": "a"}') is parse_selector('{"name": "a"}')
+    assert parse_selector('{"name": "a"}').dump() == {"name": {"=": "a"}}
+    with pytest.raises(SelectorError):
+        parse_selector('{')
+
+def test_unindexed_selectors_checked_once(monkeypatch):
+    endpoint = PeeweeEndpoint(App('db', {}), ('Person',), 'Person', Person)
+    endpoint.scan_rows = 5
+    queries = []
+    execute_sql = database.execute_sql
+    def counting(sql, *args, **kwargs):
+        queries.append(sql)
+        return execute_sql(sql, *args, **kwargs)
+    monkeypatch.setattr(database, 'execute_sql', counting)
+
+    with pytest.warns(UnindexedSelectorWarning, match='age'):
+        endpoint.get_where({"age": 3}, None, None)
+    with warnings.catch_warnings():
+        warnings.simplefilter('error')
+        for n in range(3):
+            endpoint.get_where({"age": 3}, None, None)
+        endpoint.get_where({"name": "bob"}, None, None)
+    assert len([q for q in queries if 'COUNT' in q.upper()]) == 1
+
+    endpoint.unindexed = 'reject'
+    with pytest.raises(wire.HTTPResponse) as e:
+        endpoint.get_where({"age": 3}, None, None)
+    assert e.value.status.startswith('400')
+
+@pytest.mark.parametrize('limit', [1, 3, 4, 11, None])
+def test_pages_fetched_in_batches(monkeypatch, limit):
+    endpoint = PeeweeEndpoint(App('db', {}), ('Person',), 'Person', Person)
+    endpoint.fetch_size = 3
+    queries = []
+    execute_sql = database.execute_sql
+    def counting(sql, *args, **kwargs):
+        queries.append(sql)
+        return execute_sql(sql, *args, **kwargs)
+    monkeypatch.setattr(database, 'execute_sql', counting)
+
+    seen, state = [], None
+    while True:
+        page = endpoint.get_where(None, state, limit, columns=True)
+        del queries[:]
+        rows = list(page.items) # read from the database as the page is written
+        assert len(queries) == len(rows) // 3 + 1
+        seen.extend(rows)
+        if page.next is None:
+            break
+        assert page.state == rows[-1][0]
+        state = page.state
+    assert [row[1] for row in seen] == NAMES
+
+def test_model_cache(tmp_path):
+    cache = ModelCache(str(tmp_path))
+    filename = cache.filename('sqlite:///:memory:')
+    metadata = db.Introspector.from_database(database).introspect()
+    cache.save(filename, ['key'], metadata)
+    assert cache.load(filename, ['other']) is None
+    assert cache.load(filename, ['key']).columns['person'].keys() == metadata.columns['person'].keys()
+
+def test_model_cache_failed_save(tmp_path, monkeypatch):
+    cache = ModelCache(str(tmp_path))
+    monkeypatch.setattr(db, 'dump_metadata', lambda metadata: {'bad': object()})
+    cache.save(cache.filename('sqlite:///x.db'), ['key'], None)
+    assert list(tmp_path.iterdir()) == []
@@ -0,0 +1,95 @@
+import gzip
+
+import pytest
+
+from trpc import client, wire, wsgi
+from trpc.server import App, Service, rpc
+
+
+def encodings():
+    out = [wire.GzipEncoding()]
+    try:
+        import zstandard
+    except ImportError:
+        out.append(pytest.param(None, marks=pytest.mark.skip('needs zstandard')))
+    else:
+        out.append(wire.ZstdEncoding())
+    return out
+
+DATA = b''.join(b'line %d of the body\n' % n for n in range(5000))
+
+@pytest.mark.parametrize('encoding', encodings())
+def test_round_trip(encoding):
+    chunks = [DATA[i:i+1000] for i in range(0, len(DATA), 1000)]
+    compressed = list(encoding.compress_iter(chunks))
+    assert len(compressed) > 1 # flushed as it goes
+    data = b''.join(compressed)
+    assert len(data) < len(DATA) // 4
+    assert encoding.decompress(data, len(DATA)) == DATA
+    assert encoding.decompress(data, len(DATA) - 1) is None
+    d = encoding.decompressobj()
+    assert b''.join(d.decompress(c) for c in compressed) == DATA
+    assert wire.decode_content(data, encoding.name) == DATA
+
+def test_gzip_is_gzip():
+    data = b''.join(wire.GzipEncoding().compress_iter([DATA]))
+    assert gzip.decompress(data) == DATA
+    with pytest.raises(ValueError):
+        wire.GzipEncoding().decompress(data[:-20], len(DATA))
+
+def test_negotiate_encoding():
+    assert wire.negotiate_encoding(None) is None
+    assert wire.negotiate_encoding('identity') is None
+    assert wire.negotiate_encoding('br, gzip').name == 'gzip'
+    assert wire.negotiate_encoding('gzip;q=0, br') is None
+    assert wire.negotiate_encoding('*').name in wire.ENCODINGS
+    assert wire.encoding_for(' GZIP ').name == 'gzip'
+
+class Handler(wsgi.KeepAliveRequestHandler):
+    def log_request(self, code='-', size='-'):
+        pass
+
+class Example(Service):
+    @rpc()
+    def echo(self, text: str) -> str:
+        return text
+
+    @rpc()
+    def size(self, text: str) -> int:
+        return len(text)
+
+@pytest.fixture
+def server():
+    app = App('app', {'Example': Example})
+    seen = []
+    def recording(environ, start_response):
+        def start(status, headers, *args):
+            seen.append((environ.get('HTTP_CONTENT_ENCODING'), dict(headers).get('content-encoding')))
+            return start_response(status, headers, *args)
+        return app(environ, start)
+    s = wsgi.ThreadPoolWSGIServer(recording, host='127.0.0.1', threads=2, read_timeout=5, request_handler=Handler)
+    s.seen = seen
+    s.start()
+    yield s
+    s.stop()
+
+def test_compressed_requests_and_responses(server):
+    host, port = server.server.server_address[:2]
+    api = client.open('http://{}:{}/'.format(host, port))
+    text = DATA.decode('ascii')
+    del server.seen[:]
+    assert api.Example.echo(text=text) == text # compressed response, uncompressed request
+    assert api.Example.size(text=text) == len(text) # the server compressed, so the request is too
+    assert api.Example.size(text="short") == 5 # too small to bother
+    assert server.seen == [(None, 'gzip'), ('gzip', None), (None, None)]
+
+def test_bad_request_encoding():
+    app = App('app', {'Example': Example})
+    with pytest.raises(wire.HTTPResponse) as e:
+        app.decode_body(b'nope', 'br')
+    assert e.value.status.startswith('415')
+    app.max_decompressed_size = 100
+    with pytest.raises(wire.HTTPResponse) as e:
+        app.decode_body(b''.join(wire.GzipEncoding().compress_iter([DATA])), 'gzip')
+    assert e.value.status.startswith('413')
+    assert app.decode_body(b'plain', 'identity') == b'plain'
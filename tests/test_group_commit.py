@@ -0,0 +1,76 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+peewee = pytest.importorskip('peewee')
+
+from trpc.db import GroupCommit
+
+
+class Item(peewee.Model):
+    name = peewee.CharField(unique=True)
+
+@pytest.fixture
+def database(tmp_path):
+    database = peewee.SqliteDatabase(str(tmp_path / 'items.db'))
+    Item.bind(database)
+    database.create_tables([Item])
+    yield database
+    database.close()
+
+def create(name):
+    return Item.create(name=name).id
+
+def test_writes_share_commits(database):
+    writer = GroupCommit(database, window=0.05)
+    commits = []
+    commit = writer.commit
+    writer.commit = lambda batch: commits.append(len(batch)) or commit(batch)
+    with ThreadPoolExecutor(8) as pool:
+        ids = list(pool.map(lambda n: writer.run(create, 'item {}'.format(n)), range(16)))
+    assert len(set(ids)) == 16
+    assert sum(commits) == 16 and len(commits) < 16
+    assert Item.select().count() == 16
+
+def test_failed_write_only_fails_its_caller(database):
+    writer = GroupCommit(database, window=0.05)
+    with ThreadPoolExecutor(4) as pool:
+        futures = [pool.submit(writer.run, create, name) for name in ['a', 'b', 'a', 'c']]
+    errors = [f.exception() for f in futures]
+    assert sum(isinstance(e, peewee.IntegrityError) for e in errors) == 1
+    assert sorted(i.name for i in Item.select()) == ['a', 'b', 'c']
+
+def test_for_database(database):
+    assert GroupCommit.for_database(database) is GroupCommit.for_database(database)
+
+@pytest.mark.filterwarnings('ignore::pytest.PytestUnhandledThreadExceptionWarning') # the writer dies
+def test_dead_writer(database):
+    writer = GroupCommit(database)
+    writer.check_seconds = 0.05
+    def die():
+        raise SystemExit() # not an Exception, so it ends the writer thread
+    with pytest.raises(SystemExit):
+        writer.run(die)
+    first = writer.thread
+    first.join(5)
+    assert not first.is_alive()
+    assert Item.get_by_id(writer.run(create, 'after')).name == 'after'
+    assert writer.thread is not first
+
+@pytest.mark.filterwarnings('ignore::pytest.PytestUnhandledThreadExceptionWarning') # the writer dies
+def test_writer_dies_while_callers_wait(database):
+    writer = GroupCommit(database)
+    writer.check_seconds = 0.05
+    entered, release = threading.Event(), threading.Event()
+    def die():
+        entered.set()
+        release.wait(5)
+        raise SystemExit()
+    with ThreadPoolExecutor(2) as pool:
+        dying = pool.submit(writer.run, die)
+        entered.wait(5)
+        waiting = pool.submit(writer.run, create, 'queued') # behind the dying batch
+        release.set()
+        assert isinstance(dying.exception(5), SystemExit)
+        assert Item.get_by_id(waiting.result(5)).name == 'queued'
@@ -0,0 +1,147 @@
+import threading
+import time
+import urllib.error
+
+import pytest
+
+from trpc import client, wire, wsgi
+from trpc.server import App, Future, JobTable, Service, rpc
+
+
+class Handler(wsgi.KeepAliveRequestHandler):
+    def log_request(self, code='-', size='-'):
+        pass
+
+release = threading.Event()
+
+def slow(value):
+    release.wait(10)
+    return value
+
+def broken():
+    raise ValueError("no")
+
+class Jobs(Service):
+    @rpc()
+    def start(self, value: str):
+        return Future.submit(slow, value)
+
+    @rpc()
+    def fail(self):
+        return Future.submit(broken)
+
+    @rpc(deadline=0.05)
+    def wait(self, value: str):
+        return slow(value)
+
+    @rpc(deadline=5)
+    def quick(self, value: str):
+        return value
+
+    @rpc()
+    def plain(self, value: str):
+        return slow(value)
+
+    @rpc(deadline=5)
+    def broken_now(self):
+        broken()
+
+def post(app, path, **args):
+    request = wire.HTTPRequest('POST', path, {}, {}, None, None, None, wire.Arguments(args))
+    return app.handle_request(request)
+
+@pytest.fixture
+def app():
+    release.clear()
+    app = App('app', {'Jobs': Jobs})
+    app.job_poll_seconds = 0.05
+    yield app
+    release.set()
+
+def test_job_table_wait():
+    jobs = JobTable()
+    job_id = jobs.submit(lambda: slow('done'))
+    assert jobs.wait(job_id, 0.01) == (False, None)
+    release.set()
+    assert jobs.wait(job_id, 5) == (True, 'done')
+    failed = jobs.submit(broken)
+    with pytest.raises(ValueError):
+        jobs.wait(failed, 5)
+    with pytest.raises(KeyError):
+        jobs.wait('nope', 0)
+
+def test_job_table_expiry():
+    jobs = JobTable(keep_seconds=0.05)
+    release.set()
+    done = jobs.submit(lambda: 1)
+    assert jobs.wait(done, 5) == (True, 1)
+    release.clear()
+    running = jobs.submit(lambda: slow(2))
+    time.sleep(0.1)
+    jobs.submit(lambda: 3) # expires finished jobs
+    with pytest.raises(KeyError):
+        jobs.wait(done, 0)
+    release.set()
+    assert jobs.wait(running, 5) == (True, 2) # not finished, so not expired
+
+def test_long_poll(app):
+    out = post(app, '/Jobs/start', value='x')
+    assert isinstance(out, wire.FutureResult)
+    assert out.url == app.JOB_URL and out.wait_seconds == 0
+    started = time.monotonic()
+    again = post(app, out.url, **out.args)
+    assert time.monotonic() - started >= 0.05 # held for job_poll_seconds
+    assert isinstance(again, wire.FutureResult) and again.args == out.args
+    release.set()
+    assert post(app, out.url, **out.args).value == 'x'
+
+def test_unknown_job(app):
+    with pytest.raises(wire.HTTPResponse) as e:
+        post(app, app.JOB_URL, id='nope')
+    assert e.value.status.startswith('404')
+
+def test_jobs_need_one_process(app):
+    app.processes = 2
+    with pytest.raises(wire.HTTPResponse) as e:
+        post(app, '/Jobs/start', value='x')
+    assert e.value.status.startswith('501')
+
+def test_client_waits_for_jobs(app):
+    s = wsgi.ThreadPoolWSGIServer(app, host='127.0.0.1', threads=2, read_timeout=5, request_handler=Handler)
+    s.start()
+    try:
+        host, port = s.server.server_address[:2]
+        api = client.open('http://{}:{}/'.format(host, port))
+        threading.Timer(0.2, release.set).start()
+        assert api.Jobs.start(value='later') == 'later'
+        with pytest.raises(urllib.error.HTTPError) as e:
+            api.Jobs.fail()
+        assert e.value.code == 500
+    finally:
+        s.stop()
+
+def test_deadline(app):
+    assert post(app, '/Jobs/quick', value='now').value == 'now'
+    assert app.jobs.jobs == {} # answered in time, so nothing to collect
+    out = post(app, '/Jobs/wait', value='x')
+    assert isinstance(out, wire.FutureResult)
+    assert out.url == app.JOB_URL
+    release.set()
+    assert post(app, out.url, **out.args).value == 'x'
+
+def test_app_deadline(app):
+    app.deadline = 0.05
+    out = post(app, '/Jobs/plain', value='y')
+    assert isinstance(out, wire.FutureResult)
+    release.set()
+    assert post(app, out.url, **out.args).value == 'y'
+
+def test_deadline_errors(app):
+    with pytest.raises(ValueError):
+        post(app, '/Jobs/broken_now')
+    assert app.jobs.jobs == {}
+
+def test_deadline_under_prefork(app):
+    app.processes = 2 # a poll could go to another worker, so wait it out
+    threading.Timer(0.2, release.set).start()
+    assert post(app, '/Jobs/wait', value='z').value == 'z'
@@ -0,0 +1,64 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+peewee = pytest.importorskip('peewee')
+
+from playhouse.pool import PooledDatabase
+
+from trpc import wire
+from trpc.db import PeeweeEndpoint, connect_database
+from trpc.server import App
+
+
+def pragma(database, name):
+    return database.execute_sql('PRAGMA {}'.format(name)).fetchone()[0]
+
+def test_sqlite_profile(tmp_path):
+    database = connect_database('sqlite:///{}'.format(tmp_path / 'a.db'))
+    assert isinstance(database, PooledDatabase)
+    with database.connection_context():
+        assert pragma(database, 'journal_mode') == 'wal'
+        assert pragma(database, 'synchronous') == 2 # full
+        assert pragma(database, 'busy_timeout') == 5000
+    database.close_all()
+
+def test_sqlite_synchronous(tmp_path):
+    database = connect_database('sqlite:///{}'.format(tmp_path / 'a.db'), synchronous='normal')
+    with database.connection_context():
+        assert pragma(database, 'synchronous') == 1
+    database.close_all()
+
+def test_not_pooled():
+    assert not isinstance(connect_database('sqlite:///:memory:'), PooledDatabase)
+    assert not isinstance(connect_database('sqlite:///x.db', pool=False), PooledDatabase)
+
+class Thing(peewee.Model):
+    name = peewee.CharField()
+
+Thing.make_trpc_endpoint = PeeweeEndpoint
+
+def request(app, method, path, args=None):
+    request = wire.HTTPRequest(method, path, {}, {}, None, None, None,
+        wire.Arguments(args) if args is not None else None)
+    return app.handle_request(request)
+
+def test_connection_per_request(tmp_path):
+    database = connect_database('sqlite:///{}'.format(tmp_path / 'a.db'), max_connections=2, timeout=5)
+    Thing.bind(database)
+    with database.connection_context():
+        database.create_tables([Thing])
+    app = App('app', {'Thing': Thing})
+
+    for n in range(5):
+        request(app, 'POST', '/Thing/create', {'name': str(n)})
+        assert database.is_closed() # given back
+    assert len(list(request(app, 'GET', '/Thing/list').items)) == 5
+    assert database.is_closed()
+
+    with ThreadPoolExecutor(6) as pool: # more threads than connections, so some wait for one
+        names = pool.map(lambda n: request(app, 'POST', '/Thing/create', {'name': 'x'}), range(30))
+        assert len(list(names)) == 30
+    with database.connection_context():
+        assert Thing.select().count() == 35
+    database.close_all()
@@ -0,0 +1,153 @@
+import asyncio
+import io
+import json
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from trpc import wire
+from trpc.server import App, Cursor, Service, rpc
+
+
+class Loops(Service):
+    lock = None
+
+    @rpc()
+    async def loop_id(self):
+        await asyncio.sleep(0)
+        return id(asyncio.get_running_loop())
+
+    @rpc()
+    async def locked(self, n: int):
+        # a lock made on the first call, so it belongs to that call's loop
+        if Loops.lock is None:
+            Loops.lock = asyncio.Lock()
+        async with Loops.lock:
+            await asyncio.sleep(0.01)
+        return n
+
+    @rpc(deadline=5)
+    async def with_deadline(self):
+        return id(asyncio.get_running_loop())
+
+def post(app, path, **args):
+    request = wire.HTTPRequest('POST', path, {}, {}, None, None, None, wire.Arguments(args))
+    return app.handle_request(request)
+
+@pytest.fixture
+def app():
+    Loops.lock = None
+    return App('app', {'Loops': Loops})
+
+def test_async_handlers_share_a_loop(app):
+    first = post(app, '/Loops/loop_id').value
+    assert post(app, '/Loops/loop_id').value == first
+    assert post(app, '/Loops/with_deadline').value == first
+
+def test_async_handlers_keep_loop_bound_objects(app):
+    # the lock is contended, so it is used from more than one call at once
+    executor = ThreadPoolExecutor(4)
+    futures = [executor.submit(post, app, '/Loops/locked', n=n) for n in range(8)]
+    assert [f.result(timeout=10).value for f in futures] == list(range(8))
+    executor.shutdown(wait=False)
+
+def test_async_handler_inside_a_running_loop(app):
+    async def main():
+        return post(app, '/Loops/loop_id').value
+    assert asyncio.run(main()) == post(app, '/Loops/loop_id').value
+
+def test_async_handler_on_its_own_loop(app):
+    loop = app.event_loop()
+    async def main():
+        return post(app, '/Loops/loop_id')
+    with pytest.raises(wire.HTTPResponse) as e:
+        asyncio.run_coroutine_threadsafe(main(), loop).result(5)
+    assert e.value.status.startswith('500')
+
+class Reporting(App):
+    def __init__(self, *args):
+        App.__init__(self, *args)
+        self.reported = []
+
+    def report_error(self):
+        self.reported.append(sys.exc_info()[1])
+
+class Generators(Service):
+    @rpc()
+    def fails(self, n: int):
+        for i in range(n):
+            yield "x" * 100
+        raise KeyError("boom")
+
+def wsgi_post(app, path, args, accept):
+    content_type, data = wire.Arguments(args).encode([wire.CONTENT_TYPE])
+    environ = {
+        'REQUEST_METHOD': 'POST', 'PATH_INFO': path, 'QUERY_STRING': '',
+        'CONTENT_TYPE': content_type, 'CONTENT_LENGTH': str(len(data)),
+        'wsgi.input': io.BytesIO(data), 'HTTP_ACCEPT': accept,
+    }
+    out = {}
+    def start_response(status, headers, exc_info=None):
+        out['status'], out['headers'] = status, dict(headers)
+    body = b''.join(app(environ, start_response))
+    return out['status'], out['headers']['content-type'], body
+
+def test_stream_errors_are_reported():
+    app = Reporting('app', {'Generators': Generators})
+    status, content_type, body = wsgi_post(app, '/Generators/fails', {'n': 3}, wire.STREAM_CONTENT_TYPE)
+    assert status.startswith('200') and wire.is_stream(content_type)
+    assert len(body.splitlines()) == 5
+    stream = wire.decode_bytes(body, content_type)
+    values = iter(stream.values)
+    assert [next(values) for i in range(3)] == ["x" * 100] * 3
+    with pytest.raises(wire.RemoteError, match='boom'):
+        next(values)
+    assert [type(e) for e in app.reported] == [KeyError]
+
+def test_incremental_errors_are_reported():
+    app = Reporting('app', {'Generators': Generators})
+    n = wire.CHUNK_SIZE // 100 + 10
+    status, content_type, body = wsgi_post(app, '/Generators/fails', {'n': n}, wire.CONTENT_TYPE)
+    assert status.startswith('200')
+    with pytest.raises(wire.RemoteError, match='boom'):
+        wire.decode_bytes(body, content_type)
+    assert [type(e) for e in app.reported] == [KeyError]
+
+def test_early_errors_are_500s():
+    app = Reporting('app', {'Generators': Generators})
+    status, content_type, body = wsgi_post(app, '/Generators/fails', {'n': 1}, wire.CONTENT_TYPE)
+    assert status.startswith('500')
+    assert [type(e) for e in app.reported] == [KeyError]
+
+class Cursors(Service):
+    @rpc()
+    def count(self, n: int, page_size: int):
+        return Cursor(iter(range(n)), None, None, page_size=page_size)
+
+def pages(app, n, page_size, limit=None):
+    out = [post(app, '/Cursors/count', n=n, page_size=page_size)]
+    while out[-1].next:
+        params = {'limit': json.dumps(limit)} if limit is not None else {}
+        request = wire.HTTPRequest('POST', app.CURSOR_URL, params, {}, None, None, None, wire.Arguments(out[-1].args))
+        out.append(app.handle_request(request))
+    return [page.values for page in out]
+
+@pytest.mark.parametrize('n, page_size, expected', [
+    (0, 3, [[]]),
+    (2, 3, [[0, 1]]),
+    (3, 3, [[0, 1, 2]]),
+    (6, 3, [[0, 1, 2], [3, 4, 5]]),
+    (7, 3, [[0, 1, 2], [3, 4, 5], [6]]),
+])
+def test_cursor_pages(n, page_size, expected):
+    app = App('app', {'Cursors': Cursors})
+    assert pages(app, n, page_size) == expected
+    assert len(app.cursors) == 0
+
+def test_cursor_pages_with_limits():
+    app = App('app', {'Cursors': Cursors})
+    assert pages(app, 7, 3, limit=2) == [[0, 1, 2], [3, 4], [5, 6]]
+    assert pages(app, 7, 3, limit=-5) == [[0, 1, 2], [3], [4], [5], [6]]
+    app.max_page_size = 4
+    assert pages(app, 10, 3, limit=100) == [[0, 1, 2], [3, 4, 5, 6], [7, 8, 9]]
@@ -0,0 +1,83 @@
+import io
+import json
+
+import pytest
+
+from trpc import errors, wire
+
+
+def read(text, size=1, lines=False):
+    return wire.JSONReader(io.BytesIO(text.encode('utf-8')), size=size, lines=lines).read()
+
+def sizes():
+    return [1, 2, 3, 7, 64]
+
+
+VALUES = [
+    "plain",
+    "a string, with ] and , and { inside",
+    "escapes \" \\ \n \t é ☃ \U0001f600",
+    {"nested": [1, -2.5e-3, True, None, {"x": "y"}]},
+    12345678901234567890,
+    [],
+    {},
+]
+
+@pytest.mark.parametrize('size', sizes())
+def test_compact(size):
+    obj = {"kind": "List", "values": VALUES, "n": 10.5}
+    assert read(json.dumps(obj), size) == obj
+
+@pytest.mark.parametrize('size', sizes())
+def test_pretty_printed(size):
+    obj = {"kind": "List", "values": VALUES}
+    assert read(json.dumps(obj, indent=2), size) == obj
+
+@pytest.mark.parametrize('size', sizes())
+def test_pretty_printed_ignores_lines_without_signal(size):
+    # items start after a newline, but span several lines
+    text = '{"values": [\n  {\n    "a": "b\\nc"\n  },\n  [\n    1,\n    2\n  ]\n]}'
+    assert read(text, size) == {"values": [{"a": "b\nc"}, [1, 2]]}
+
+@pytest.mark.parametrize('size', sizes())
+def test_lines(size):
+    codec = wire.JSONCodec()
+    text = b''.join(codec.dumps_iter({"kind": "List"}, "values", iter(VALUES))).decode('utf-8')
+    assert read(text, size, lines=True) == {"kind": "List", "values": VALUES}
+    assert read(text, size) == {"kind": "List", "values": VALUES}
+
+@pytest.mark.parametrize('size', sizes())
+def test_multibyte_split(size):
+    obj = {"values": ["é☃\U0001f600" * 5]}
+    assert read(json.dumps(obj, ensure_ascii=False), size) == obj
+
+def test_truncated():
+    with pytest.raises(ValueError):
+        read('{"values": ["abc", "de')
+
+def test_iter_content_type():
+    content_type, _ = wire.ResultSet(values=[1, 2]).encode_iter([wire.CONTENT_TYPE])
+    assert wire.media_params(content_type) == {'lines': '1'}
+    assert wire.codec_for(content_type) is not None
+
+def failing(n):
+    for i in range(n):
+        yield "x" * 100
+    raise KeyError("boom")
+
+def test_error_before_first_chunk():
+    with pytest.raises(KeyError):
+        list(wire.JSONCodec().dumps_iter({}, "values", failing(1)))
+
+def test_error_after_first_chunk():
+    content_type = wire.JSONCodec.iter_content_type
+    n = wire.CHUNK_SIZE // 100 + 10
+    data = b''.join(wire.JSONCodec().dumps_iter({"kind": "List"}, "values", failing(n)))
+    obj = json.loads(data)
+    assert len(obj["values"]) == n
+    with pytest.raises(wire.RemoteError, match="boom") as e:
+        wire.decode_file(io.BytesIO(data), content_type)
+    assert e.value.status == "500 bad"
+    assert isinstance(e.value, errors.Error)
+    with pytest.raises(wire.RemoteError, match="boom"):
+        wire.decode_bytes(data, content_type)
@@ -0,0 +1,186 @@
+import io
+import os
+import http.client
+import signal
+import socket
+import threading
+import time
+
+import pytest
+
+from trpc import wsgi
+
+
+class Handler(wsgi.KeepAliveRequestHandler):
+    def log_request(self, code='-', size='-'):
+        pass
+
+def app(environ, start_response):
+    path = environ['PATH_INFO']
+    if path == '/echo':
+        data = environ['wsgi.input'].read(int(environ.get('CONTENT_LENGTH') or 0))
+        start_response('200 OK', [('Content-Type', 'text/plain'), ('Content-Length', str(len(data)))])
+        return [data]
+    elif path == '/chunked':
+        start_response('200 OK', [('Content-Type', 'text/plain')])
+        return (part for part in [b'one ', b'', b'two'])
+    elif path == '/ignore':
+        start_response('200 OK', [('Content-Type', 'text/plain'), ('Content-Length', '2')])
+        return [b'ok']
+    elif path == '/fail':
+        raise ValueError('fail')
+    body = path.encode('utf-8')
+    start_response('200 OK', [('Content-Type', 'text/plain'), ('Content-Length', str(len(body)))])
+    return [body]
+
+@pytest.fixture
+def server():
+    s = wsgi.ThreadPoolWSGIServer(app, host='127.0.0.1', threads=2, read_timeout=5, request_handler=Handler)
+    s.start()
+    yield s
+    s.stop()
+
+def address(server):
+    return server.server.server_address[:2]
+
+class Unclosed(io.BufferedReader):
+    """ HTTPResponse closes its file after each response """
+    def close(self):
+        pass
+
+class Responses:
+    """ reads responses one after another from a socket, for pipelining """
+    def __init__(self, sock):
+        self.file = Unclosed(socket.SocketIO(sock, 'rb'))
+
+    def makefile(self, mode):
+        return self.file
+
+    def read(self):
+        response = http.client.HTTPResponse(self)
+        response.begin()
+        return response.status, response.getheaders(), response.read()
+
+def test_keep_alive(server):
+    conn = http.client.HTTPConnection(*address(server), timeout=5)
+    conn.request('GET', '/a')
+    response = conn.getresponse()
+    assert response.read() == b'/a'
+    sock = conn.sock
+    for path in ('/b', '/c'):
+        conn.request('POST', '/echo', body=path.encode('utf-8'))
+        response = conn.getresponse()
+        assert not response.will_close
+        assert response.read() == path.encode('utf-8')
+    assert conn.sock is sock
+    conn.close()
+
+def test_pipelining(server):
+    with socket.create_connection(address(server), timeout=5) as sock:
+        sock.sendall(
+            b'GET /one HTTP/1.1\r\nHost: x\r\n\r\n'
+            b'POST /echo HTTP/1.1\r\nHost: x\r\nContent-Length: 5\r\n\r\nhello'
+            b'POST /ignore HTTP/1.1\r\nHost: x\r\nContent-Length: 3\r\n\r\nabc'
+            b'GET /chunked HTTP/1.1\r\nHost: x\r\n\r\n'
+            b'GET /two HTTP/1.1\r\nHost: x\r\n\r\n'
+        )
+        responses = Responses(sock)
+        assert responses.read()[2] == b'/one'
+        assert responses.read()[2] == b'hello'
+        assert responses.read()[2] == b'ok'
+        status, headers, body = responses.read()
+        assert dict(headers).get('Transfer-Encoding') == 'chunked'
+        assert body == b'one two'
+        assert responses.read()[2] == b'/two'
+
+def test_http_10_closes(server):
+    with socket.create_connection(address(server), timeout=5) as sock:
+        sock.sendall(b'GET /chunked HTTP/1.0\r\n\r\n')
+        data = b''
+        while True:
+            chunk = sock.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+    assert data.endswith(b'\r\n\r\none two')
+
+def test_error_closes(server):
+    with socket.create_connection(address(server), timeout=5) as sock:
+        sock.sendall(b'GET /fail HTTP/1.1\r\nHost: x\r\n\r\n')
+        status, headers, body = Responses(sock).read()
+        assert status == 500
+        assert dict(headers).get('Connection') == 'close'
+
+def test_request_chunked_body_refused(server):
+    with socket.create_connection(address(server), timeout=5) as sock:
+        sock.sendall(b'POST /echo HTTP/1.1\r\nHost: x\r\nTransfer-Encoding: chunked\r\n\r\n0\r\n\r\n')
+        assert Responses(sock).read()[0] == 411
+
+def test_idle_connections_do_not_hold_workers(server):
+    idle = []
+    for i in range(4): # more than the two worker threads
+        conn = http.client.HTTPConnection(*address(server), timeout=5)
+        conn.request('GET', '/idle')
+        assert conn.getresponse().read() == b'/idle'
+        idle.append(conn)
+    conn = http.client.HTTPConnection(*address(server), timeout=5)
+    conn.request('GET', '/busy')
+    assert conn.getresponse().read() == b'/busy'
+    for c in idle + [conn]:
+        c.close()
+
+def test_concurrent_connections(server):
+    results = []
+    def client(n):
+        conn = http.client.HTTPConnection(*address(server), timeout=5)
+        for i in range(10):
+            path = '/{}/{}'.format(n, i)
+            conn.request('GET', path)
+            results.append(conn.getresponse().read() == path.encode('utf-8'))
+        conn.close()
+    threads = [threading.Thread(target=client, args=(n,)) for n in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join(10)
+    assert results == [True] * 80
+
+def blocked(environ, start_response):
+    signals = signal.pthread_sigmask(signal.SIG_BLOCK, [])
+    body = ' '.join(sorted(signal.Signals(s).name for s in signals)).encode('ascii')
+    start_response('200 OK', [('Content-Type', 'text/plain'), ('Content-Length', str(len(body)))])
+    return [body]
+
+@pytest.mark.skipif(not hasattr(os, 'fork'), reason='needs fork')
+def test_prefork_respawned_workers_get_sigchld():
+    server = wsgi.PreforkServer(blocked, host='127.0.0.1', workers=1, threads=2, request_handler=Handler)
+    results = []
+    def supervise():
+        signal.pthread_sigmask(signal.SIG_BLOCK, {signal.SIGCHLD, *server.Signals})
+        try:
+            for n in range(2):
+                conn = http.client.HTTPConnection(*address(server), timeout=5)
+                conn.request('GET', '/')
+                results.append(conn.getresponse().read().decode('ascii').split())
+                conn.close()
+                if n == 0:
+                    pid = next(iter(server.pids))
+                    os.kill(pid, signal.SIGKILL)
+                    deadline = time.monotonic() + 5
+                    while pid in server.pids or not server.pids:
+                        assert time.monotonic() < deadline
+                        time.sleep(0.02)
+                    time.sleep(1.5) # the respawn waits a second after an early exit
+        finally:
+            os.kill(os.getpid(), signal.SIGTERM)
+    server.start()
+    thread = threading.Thread(target=supervise)
+    thread.start()
+    try:
+        server.wait()
+    finally:
+        server.stop()
+        thread.join(10)
+    assert len(results) == 2
+    for signals in results:
+        assert 'SIGCHLD' not in signals
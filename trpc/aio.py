@@ -0,0 +1,421 @@
+"""
+asyncio client:
+
+    api = await trpc.aio.open("http://127.0.0.1:1729/")
+
+    print(await api.Example.hello(name="async"))
+
+    async for n in api.Example.hello_cursor():
+        print(n)
+
+    out = await trpc.aio.gather(*[api.Example.hello(name=n) for n in names], limit=20)
+
+attribute access and calls are lazy, nothing is fetched until awaited
+"""
+
+import asyncio
+import email.parser
+import http.client
+import urllib.error
+import time
+import io
+
+from urllib.parse import urljoin, urlencode, urlsplit
+
+from . import wire
+
+class Pending:
+    """ a path of walks and calls, resolved when awaited """
+    def __init__(self, client, steps):
+        self._client = client
+        self._steps = steps
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return Pending(self._client, self._steps + (('walk', name),))
+
+    def __call__(self, **args):
+        return Pending(self._client, self._steps + (('call', args),))
+
+    def __await__(self):
+        return self._resolve().__await__()
+
+    async def _resolve(self):
+        obj = self._client
+        for step, arg in self._steps:
+            if not isinstance(obj, APIClient):
+                raise TypeError("can't {} {!r} on a {}".format(step, arg, type(obj).__name__))
+            if step == 'walk':
+                obj = await obj._walk(arg)
+            else:
+                obj = await obj._call(arg)
+        return obj
+
+    def __aiter__(self):
+        return self._iterate()
+
+    async def _iterate(self):
+        obj = await self
+        async for item in obj:
+            yield item
+
+class APIClient:
+    Kinds = {}
+    def __init__(self, response, url, session=None):
+        self._url = url
+        self._response = response
+        self._session = session
+
+    def __init_subclass__(cls):
+        cls.Kinds[cls.__name__] = cls
+
+    @classmethod
+    def wrap(cls, response, url, session):
+        if response.kind == 'Result':
+            return response.value
+        c = cls.Kinds.get(response.kind, cls)
+        return c(response, url, session)
+
+    async def _fetch(self, req):
+        url, response = await self._session.request(req, self._url)
+        return self.wrap(response, url, self._session)
+
+class Navigable(APIClient):
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return Pending(self, (('walk', name),))
+
+    async def _walk(self, name):
+        req = self._response.walk(name)
+        return await self._fetch(req)
+
+class Callable(APIClient):
+    def __call__(self, **args):
+        return Pending(self, (('call', args),))
+
+    async def _call(self, args):
+        req = self._response.call(dict(args))
+        return await self._fetch(req)
+
+class ResultSet(APIClient):
+    async def __aiter__(self):
+        obj, url = self._response, self._url
+        while obj is not None:
+            for item in obj.enumerate():
+                yield item.value
+
+            req = obj.request_next()
+            if req:
+                url, obj = await self._session.request(req, url)
+            else:
+                obj = None
+
+class Stream(APIClient):
+    """ the whole body is read before the first value, see client.Stream """
+    async def __aiter__(self):
+        for item in self._response.enumerate():
+            yield item.value
+
+class Namespace(Navigable):
+    pass
+
+class Service(Navigable):
+    pass
+
+class Procedure(Callable):
+    pass
+
+class Model(APIClient):
+    async def get(self, key):
+        req = self._response.get_entry(key)
+        return await self._fetch(req)
+
+    async def create(self, **args):
+        req = self._response.create_entry(args)
+        return await self._fetch(req)
+
+    async def create_many(self, items):
+        req = self._response.create_many(items)
+        return await self._fetch(req)
+
+    async def delete(self, key):
+        req = self._response.delete_entry(key)
+        return await self._fetch(req)
+
+    async def delete_many(self, keys):
+        req = self._response.delete_many(keys)
+        return await self._fetch(req)
+
+    async def list(self, limit=None):
+        req = self._response.get_where(None, limit, self._session.columns)
+        return await self._fetch(req)
+
+    async def where(self, **args):
+        req = self._response.get_where(args, None, self._session.columns)
+        return await self._fetch(req)
+
+class EntrySet(APIClient):
+    async def __aiter__(self):
+        obj, url = self._response, self._url
+        while obj is not None:
+            for item in obj.enumerate():
+                yield self.wrap(item, url, self._session)
+
+            req = obj.request_next()
+            if req:
+                url, obj = await self._session.request(req, url)
+            else:
+                obj = None
+
+class Entry(APIClient):
+    def __getattr__(self, name):
+        return self._response.attributes[name]
+
+class Response:
+    def __init__(self, url, status, reason, headers, body):
+        self.url = url
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.body = body
+
+    def getheader(self, name, default=None):
+        return self.headers.get(name, default)
+
+class Connection:
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self.last_used = time.monotonic()
+        self.sent = False # the last request was written, so the server may have run it
+
+    def close(self):
+        self.writer.close()
+
+    async def request(self, method, host, path, body, headers):
+        lines = ["{} {} HTTP/1.1".format(method, path), "Host: {}".format(host)]
+        lines.extend("{}: {}".format(k, v) for k, v in headers.items())
+        lines.append("Content-Length: {}".format(len(body or b'')))
+        self.sent = False
+        self.writer.write("\r\n".join(lines).encode('latin-1') + b"\r\n\r\n" + (body or b''))
+        await self.writer.drain()
+        self.sent = True
+
+        status_line = await self.reader.readline()
+        if not status_line:
+            raise http.client.RemoteDisconnected("connection closed")
+        version, status, reason = (status_line.decode('latin-1').rstrip('\r\n').split(' ', 2) + [''])[:3]
+        status = int(status)
+
+        header_lines = []
+        while True:
+            line = await self.reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            header_lines.append(line.decode('latin-1'))
+        headers = email.parser.Parser(_class=http.client.HTTPMessage).parsestr(''.join(header_lines))
+
+        will_close = version == 'HTTP/1.0' or (headers.get('connection') or '').lower() == 'close'
+        if method == 'HEAD' or status in (204, 304) or 100 <= status < 200:
+            data = b''
+        elif (headers.get('transfer-encoding') or '').lower() == 'chunked':
+            chunks = []
+            while True:
+                size = int((await self.reader.readline()).split(b';', 1)[0], 16)
+                if not size:
+                    while (await self.reader.readline()) not in (b'\r\n', b'\n', b''):
+                        pass
+                    break
+                chunks.append(await self.reader.readexactly(size))
+                await self.reader.readexactly(2)
+            data = b''.join(chunks)
+        elif headers.get('content-length') is not None:
+            data = await self.reader.readexactly(int(headers['content-length']))
+        else:
+            data = await self.reader.read()
+            will_close = True
+
+        self.last_used = time.monotonic()
+        return status, reason, headers, data, will_close
+
+class ConnectionPool:
+    """
+        persistent HTTP/1.1 connections for the asyncio client, kept per
+        (scheme, host, port), see client.ConnectionPool
+    """
+    Redirects = (301, 302, 303, 307, 308)
+    Idempotent = ('GET', 'HEAD') # safe to send again when a reused connection fails
+
+    def __init__(self, maxsize=10, idle_timeout=30, timeout=None, max_redirects=10):
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.max_redirects = max_redirects
+        self.idle = {}
+
+    async def connect(self, key):
+        scheme, host, port = key
+        out = asyncio.open_connection(host, port, ssl=(scheme == 'https') or None)
+        if self.timeout is not None:
+            out = asyncio.wait_for(out, self.timeout)
+        reader, writer = await out
+        return Connection(reader, writer)
+
+    def checkout(self, key):
+        now = time.monotonic()
+        idle = self.idle.get(key)
+        while idle:
+            conn = idle.pop()
+            if now - conn.last_used < self.idle_timeout and not conn.reader.at_eof():
+                return conn
+            conn.close()
+
+    def release(self, key, conn):
+        idle = self.idle.setdefault(key, [])
+        if len(idle) < self.maxsize:
+            idle.append(conn)
+        else:
+            conn.close()
+
+    async def close(self):
+        idle, self.idle = self.idle, {}
+        for conns in idle.values():
+            for conn in conns:
+                conn.close()
+
+    async def open(self, method, url, body=None, headers=None):
+        parts = urlsplit(url)
+        if parts.scheme not in ('http', 'https'):
+            raise ValueError("unsupported url: {}".format(url))
+        port = parts.port or (443 if parts.scheme == 'https' else 80)
+        key = (parts.scheme, parts.hostname, port)
+        host = parts.netloc.rsplit('@', 1)[-1]
+        path = parts.path or '/'
+        if parts.query:
+            path = '{}?{}'.format(path, parts.query)
+        headers = headers or {}
+
+        conn = self.checkout(key)
+        if conn is not None:
+            try:
+                return await self.exchange(key, conn, url, method, host, path, body, headers)
+            except (ConnectionError, asyncio.IncompleteReadError):
+                # closed by the server while idle, so retry once, unless it may have run the request
+                if conn.sent and method not in self.Idempotent:
+                    raise
+
+        conn = await self.connect(key)
+        return await self.exchange(key, conn, url, method, host, path, body, headers)
+
+    async def exchange(self, key, conn, url, method, host, path, body, headers):
+        try:
+            out = conn.request(method, host, path, body, headers)
+            if self.timeout is not None:
+                out = asyncio.wait_for(out, self.timeout)
+            status, reason, response_headers, data, will_close = await out
+        except BaseException:
+            conn.close()
+            raise
+        if will_close:
+            conn.close()
+        else:
+            self.release(key, conn)
+        return Response(url, status, reason, response_headers, data)
+
+    async def urlopen(self, method, url, body=None, headers=None):
+        """ follows redirects, raises urllib.error.HTTPError, like client.ConnectionPool """
+        headers = dict(headers or {})
+        for _ in range(self.max_redirects + 1):
+            response = await self.open(method, url, body, headers)
+            if response.status in self.Redirects and response.getheader('location'):
+                url = urljoin(url, response.getheader('location'))
+                if response.status in (301, 302, 303) and method != 'HEAD':
+                    method, body = 'GET', None
+                    headers = {k:v for k,v in headers.items() if k.lower() not in ('content-type', 'content-encoding')}
+                continue
+            if not 200 <= response.status < 300:
+                raise urllib.error.HTTPError(url, response.status, response.reason, response.headers, io.BytesIO(response.body))
+            return response
+        raise urllib.error.HTTPError(url, response.status, 'too many redirects', response.headers, None)
+
+class Session:
+    max_poll_seconds = 10 # longest wait between polls of a FutureResult
+    columns = True # ask for EntrySets as rows, see client.Session
+
+    def __init__(self, pool=None):
+        self.pool = pool if pool is not None else ConnectionPool()
+        self.servers = {} # url_origin -> (content_type, content_encoding), see client.Session.negotiated
+
+    async def close(self):
+        await self.pool.close()
+
+    def negotiated(self, url):
+        return self.servers.get(wire.url_origin(url), (wire.CONTENT_TYPE, None))
+
+    def learn(self, url, content_type, content_encoding):
+        codec = wire.codec_for(content_type)
+        encoding = wire.encoding_for(content_encoding)
+        if codec or encoding:
+            old_type, old_encoding = self.negotiated(url)
+            self.servers[wire.url_origin(url)] = (
+                codec.content_type if codec else old_type,
+                encoding.name if encoding else old_encoding)
+
+    async def raw_request(self, request, base_url=None, cached=None):
+        headers = {'Accept': wire.accept_header(), 'Accept-Encoding': wire.accept_encoding_header()}
+        if isinstance(request, str):
+            request = wire.HTTPRequest("GET", request, {}, headers, None, None, cached)
+        elif isinstance(request, wire.Request):
+            request = request.make_http(base_url, self.negotiated(urljoin(base_url or '', request.path))[0])
+
+        obj = request.cached
+
+        if obj is None:
+            url = request.url
+            if request.content_type:
+                headers['Content-Type'] = request.content_type
+            if request.headers:
+                headers.update(request.headers)
+            if request.params:
+                url = '{}?{}'.format(url, urlencode(request.params))
+            data = request.data
+            encoding = wire.encoding_for(self.negotiated(url)[1])
+            if encoding and data and len(data) >= wire.COMPRESS_MIN_SIZE:
+                data = b''.join(encoding.compress_iter([data]))
+                headers['Content-Encoding'] = encoding.name
+            response = await self.pool.urlopen(request.method, url, data, headers)
+            content_type = response.getheader('content-type')
+            content_encoding = response.getheader('content-encoding')
+            self.learn(response.url, content_type, content_encoding)
+            body = wire.decode_content(response.body, content_encoding)
+            return response.url, wire.decode_bytes(body, content_type)
+        else:
+            return request.url, wire.decode_object(obj)
+
+    async def request(self, request, base_url=None):
+        """ Handle redirects, futures, waiting between polls as the server asks """
+        url = base_url
+        polls = 0
+        while True:
+            url, result = await self.raw_request(request, url)
+            if isinstance(result, wire.FutureResult):
+                await asyncio.sleep(result.poll_delay(polls, self.max_poll_seconds))
+                polls += 1
+                request = result.make_request()
+            else:
+                return url, result
+
+async def gather(*aws, limit=10, return_exceptions=False):
+    """ like asyncio.gather, but with at most limit awaitables running at once """
+    semaphore = asyncio.Semaphore(limit)
+    async def run(aw):
+        async with semaphore:
+            return await aw
+    return await asyncio.gather(*(run(aw) for aw in aws), return_exceptions=return_exceptions)
+
+async def open(request, schema=None, session=None):
+    session = session or Session()
+    url, response = await session.request(request)
+    return APIClient.wrap(response, url, session)
@@ -8,6 +8,9 @@ import unicodedata
 import contextlib
 import os.path
 import json
+import time
+import hashlib
+import itertools
 
 from datetime import datetime, timezone
 
@@ -310,11 +313,102 @@ def parse_argument(kind, value):
     return value
 
 
+def read_batches(fh, size):
+    """
+        a json list, or one json value per line, in lists of at most size.
+        lines are read as they're needed, a json list is read in full
+    """
+    lines = (line for line in fh if line.strip())
+    first = next(lines, None)
+    if first is None:
+        return
+    if first.lstrip().startswith('['):
+        items = json.loads(first + fh.read())
+        for i in range(0, len(items), size):
+            yield items[i:i+size]
+        return
+    batch = []
+    for line in itertools.chain([first], lines):
+        batch.append(json.loads(line))
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+class SchemaCache:
+    """
+        keeps the root schema of each TRPC_URL on disk, so that tab completion
+        can walk the embedded routes without a round trip per TAB press.
+
+        entries younger than ttl seconds are used as is, older ones are
+        revalidated with If-None-Match
+
+        $TRPC_CACHE_DIR overrides the directory, $TRPC_CACHE_TTL the ttl
+    """
+
+    def __init__(self, session, path, ttl=60):
+        self.session = session
+        self.path = path
+        self.ttl = ttl
+
+    @classmethod
+    def from_environ(cls, session, environ):
+        path = environ.get('TRPC_CACHE_DIR')
+        if not path:
+            base = environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+            path = os.path.join(base, 'trpc')
+        ttl = float(environ.get('TRPC_CACHE_TTL', 60))
+        return cls(session, path, ttl)
+
+    def filename(self, url):
+        name = hashlib.sha1(url.encode('utf-8')).hexdigest()
+        return os.path.join(self.path, "{}.json".format(name))
+
+    def load(self, url):
+        try:
+            with open(self.filename(url)) as fh:
+                entry = json.load(fh)
+        except (OSError, ValueError):
+            return None
+        if entry.get('url') == url:
+            return entry
+
+    def save(self, url, entry):
+        filename = self.filename(url)
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            tmp = "{}.{}".format(filename, os.getpid())
+            with open(tmp, 'w') as fh:
+                json.dump(entry, fh)
+            os.replace(tmp, filename)
+        except OSError:
+            pass
+
+    def request(self, url):
+        """ returns (url, obj) for the schema at url """
+        entry = self.load(url)
+        now = time.time()
+        if entry and now - entry['fetched'] < self.ttl:
+            return entry['location'], wire.decode_object(entry['schema'])
+
+        location, etag, obj = self.session.revalidate(url, entry and entry['etag'])
+
+        if obj is None:
+            entry['fetched'] = now
+            obj = wire.decode_object(entry['schema'])
+        else:
+            entry = dict(url=url, location=location, etag=etag, fetched=now, schema=obj.embed())
+
+        if entry['etag']:
+            self.save(url, entry)
+        return location, obj
+
 class CLI:
     MODES = set((
         'call', 'get', 'list',
         'set', 'update', 'create',
-        'delete',   
+        'delete', 'create_many', 'delete_many',
         'watch', 'exec',
         'help', 'routes','modes',
     ))
@@ -398,6 +492,19 @@ class CLI:
             _, key = args[0]
             req = obj.delete_entry(key)
             url, obj = self.session.request(req, url) 
+        elif mode == 'create_many':
+            # rows from stdin, each batch a transaction of its own
+            batch = int(dict(args).get('batch', 10000))
+            count = 0
+            for items in read_batches(sys.stdin, batch):
+                _, out = self.session.request(obj.create_many(items), url)
+                count += out.value
+            obj = wire.Result(count)
+        elif mode == 'delete_many':
+            keys = [v for k, v in args if k is None]
+            if not keys:
+                keys = sys.stdin.read().split()
+            _, obj = self.session.request(obj.delete_many(keys), url)
         elif mode == 'update':
             pass
         elif mode == 'set':
@@ -469,6 +576,12 @@ class CLI:
         ctx = self.parser.parse(app_args, named_args=True)
         return ctx, mode, path, args
 
+    def complete_root(self, environ, endpoint):
+        if isinstance(endpoint, str):
+            cache = SchemaCache.from_environ(self.session, environ)
+            return cache.request(endpoint)
+        return self.session.request(endpoint, None)
+
     def complete(self, environ, prefix):
         endpoint = environ.get("TRPC_URL", "")
 
@@ -490,7 +603,7 @@ class CLI:
                 if m.startswith(first):
                     out.append('{} '.format(m))
 
-        url, obj = self.session.request(endpoint, None)
+        url, obj = self.complete_root(environ, endpoint)
     
         route = []
         filter = None
@@ -1,9 +1,15 @@
-import urllib.request
+import urllib.error
+import http.client
+import threading
+import queue
+import socket
+import time
+import io
 import sys
 import os
 import json
 
-from urllib.parse import urljoin, urlencode
+from urllib.parse import urljoin, urlencode, urlsplit
 
 from . import wire
 
@@ -38,18 +44,126 @@ class Callable(APIClient):
         req = self._response.call(args)
         return self._fetch(req)
 
-class ResultSet(APIClient):
+class ReadAhead:
+    """
+        runs an iterator in a background thread, so the next items are
+        fetched while the caller works on this one. at most `ahead` items
+        wait in the queue, and errors are raised in the caller
+    """
+    Done = object()
+
+    def __init__(self, iterator, ahead=1):
+        self.queue = queue.Queue(maxsize=max(ahead, 1))
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, args=(iterator,), name='trpc-prefetch', daemon=True)
+        self.thread.start()
+
+    def run(self, iterator):
+        try:
+            for item in iterator:
+                self.queue.put((item, None))
+                if self.stopped.is_set():
+                    return
+        except BaseException as e:
+            self.queue.put((None, e))
+            return
+        self.queue.put((self.Done, None))
+
     def __iter__(self):
-        obj, url = self._response, self._url
+        try:
+            while True:
+                item, error = self.queue.get()
+                if error is not None:
+                    raise error
+                if item is self.Done:
+                    return
+                yield item
+        finally:
+            # the caller stopped early, so unblock the thread and let it exit
+            self.stopped.set()
+            while True:
+                try:
+                    self.queue.get_nowait()
+                except queue.Empty:
+                    break
+
+class PageSize:
+    """
+        the limit sent for the next page. with a target, it is grown or
+        shrunk after each page, toward target_seconds per round trip or
+        target_bytes per response, by at most a factor of 2 at a time
+    """
+    def __init__(self, size=None, target_seconds=None, target_bytes=None, min_size=1, max_size=100000):
+        self.size = size
+        self.target_seconds = target_seconds
+        self.target_bytes = target_bytes
+        self.min_size = min_size
+        self.max_size = max_size
+
+    def update(self, count, seconds, received=None):
+        """ count is the number of items in the page just fetched, the server may cap it """
+        ratios = []
+        if self.target_seconds and seconds:
+            ratios.append(self.target_seconds / seconds)
+        if self.target_bytes and received:
+            ratios.append(self.target_bytes / received)
+        if not count or not ratios:
+            return
+        ratio = min(max(min(ratios), 0.5), 2.0)
+        self.size = min(max(int(count * ratio), self.min_size), self.max_size)
+
+def iter_pages(session, obj, url, prefetch=0, page_size=None):
+    """
+        (url, page) for each page of a ResultSet or EntrySet, fetching up to
+        prefetch pages ahead. page_size is a limit for each request, or a PageSize
+    """
+    if not isinstance(page_size, PageSize):
+        page_size = PageSize(page_size)
+
+    def count(page):
+        return len(getattr(page, page.Incremental, None) or ()) if page.Incremental else 0
+
+    if page_size.size is None and (page_size.target_seconds or page_size.target_bytes):
+        page_size.size = count(obj) or None # adapt from the size of the first page
+
+    def fetch(obj, url):
         while obj is not None:
-            for item in obj.enumerate():
-                yield item.value
-
-            req = obj.request_next()
+            yield url, obj
+            req = obj.request_next(page_size.size)
             if req:
-                url, obj = self._session.request(req, url)
+                start = time.monotonic()
+                url, obj = session.request(req, url)
+                page_size.update(count(obj), time.monotonic() - start, getattr(obj, 'received', None))
             else:
                 obj = None
+    if prefetch and obj.request_next() is not None:
+        return iter(ReadAhead(fetch(obj, url), prefetch))
+    return fetch(obj, url)
+
+class ResultSet(APIClient):
+    def __iter__(self):
+        return self.items()
+
+    def prefetch(self, pages=1):
+        """ iterate, fetching the next pages in the background """
+        return self.items(prefetch=pages)
+
+    def items(self, page_size=None, target_seconds=None, target_bytes=None, prefetch=None):
+        """ iterate, asking for page_size items per page, or adapting it toward a target, see PageSize """
+        if prefetch is None:
+            prefetch = self._session.prefetch
+        if page_size is None:
+            page_size = self._session.page_size
+        page_size = PageSize(page_size, target_seconds, target_bytes)
+        for url, obj in iter_pages(self._session, self._response, self._url, prefetch, page_size):
+            for item in obj.enumerate():
+                yield item.value
+
+class Stream(APIClient):
+    """ values as they arrive, can only be iterated once """
+    def __iter__(self):
+        for item in self._response.enumerate():
+            yield item.value
 
 class Namespace(Navigable):
     pass
@@ -74,51 +188,352 @@ class Model(APIClient):
         req = self._response.create_entry(args)
         return self._fetch(req)
 
+    def create_many(self, items):
+        """ a list of dicts, created in one transaction, returns how many """
+        req = self._response.create_many(items)
+        return self._fetch(req)
+
     def delete(self, key):
         req = self._response.delete_entry(key)
         return self._fetch(req)
 
-    def list(self):
-        req = self._response.get_where(None)
+    def delete_many(self, keys):
+        req = self._response.delete_many(keys)
+        return self._fetch(req)
+
+    def list(self, limit=None):
+        req = self._response.get_where(None, limit, self._session.columns)
         return self._fetch(req)
 
     def next(self):
         return self.list()
 
     def where(self, **args):
-        pass
+        """ name=value, or name={">=": 1, "<": 10}, see db.Selector """
+        req = self._response.get_where(args, None, self._session.columns)
+        return self._fetch(req)
 
     def not_where(self, **args):
-        pass
+        req = self._response.get_where({'$not': args}, None, self._session.columns)
+        return self._fetch(req)
+
+    def explain(self, **args):
+        """ how the server would run where(**args) """
+        req = self._response.explain_where(args)
+        return self._fetch(req)
 
 class EntrySet(APIClient):
     def __iter__(self):
-        obj, url = self._response, self._url
-        while obj is not None:
+        return self.items()
+
+    def prefetch(self, pages=1):
+        """ iterate, fetching the next pages in the background """
+        return self.items(prefetch=pages)
+
+    def items(self, page_size=None, target_seconds=None, target_bytes=None, prefetch=None):
+        """ iterate, asking for page_size entries per page, or adapting it toward a target, see PageSize """
+        if prefetch is None:
+            prefetch = self._session.prefetch
+        if page_size is None:
+            page_size = self._session.page_size
+        page_size = PageSize(page_size, target_seconds, target_bytes)
+        for url, obj in iter_pages(self._session, self._response, self._url, prefetch, page_size):
             for item in obj.enumerate():
                 yield self.wrap(item, url, self._session)
 
-            req = obj.request_next()
-            if req:
-                url, obj = self._session.request(req, url)
-            else:
-                obj = None
-    pass
-
 class Entry(APIClient): 
     def __getattr__(self, name):
         return self._response.attributes[name]
 
+class BatchCall:
+    def __init__(self, batch, url):
+        self.batch = batch
+        self.url = url
+        self.done = False
+        self.value = None
+        self.error = None
+
+    def result(self):
+        if not self.done:
+            self.batch.flush()
+        if self.error is not None:
+            raise self.error
+        return self.value
+
+class Batch:
+    """
+        queues up procedure calls, and sends them in one request
+
+            with client.Batch(api) as batch:
+                a = batch.call(api.Example.hello, name="a")
+                b = batch.call(api.Example.sum, num=[1, 2])
+            print(a.result(), b.result())
+
+        with parallel=True, the server may run the calls concurrently
+    """
+    def __init__(self, root, parallel=False):
+        self.root = root
+        self.url = urljoin(root._url, '.')
+        self.parallel = parallel
+        self.pending = []
+
+    def call(self, procedure, **args):
+        req = procedure._response.call(args)
+        url = urljoin(procedure._url, req.path)
+        if url.startswith(self.url):
+            path = '/' + url[len(self.url):]
+        else:
+            path = urlsplit(url).path
+        item = BatchCall(self, url)
+        self.pending.append((path, req.params, req.args, item))
+        return item
+
+    def flush(self):
+        pending, self.pending = self.pending, []
+        if not pending:
+            return
+
+        batch = wire.Batch([], parallel=self.parallel)
+        for path, params, args, item in pending:
+            batch.add(path, params, args)
+        session = self.root._session
+        content_type, data = batch.encode([session.negotiated(self.url)[0]])
+        request = wire.HTTPRequest('POST', self.url, {}, {}, content_type, data, None)
+
+        url, result = session.raw_request(request)
+        for (path, params, args, item), response in zip(pending, result.enumerate()):
+            try:
+                if isinstance(response, wire.Error):
+                    code = int(response.status.split(' ', 1)[0])
+                    raise urllib.error.HTTPError(item.url, code, response.message, None, None)
+                url = item.url
+                if isinstance(response, wire.FutureResult):
+                    url, response = session.request(response.make_request(), url)
+                item.value = APIClient.wrap(response, url, session)
+            except Exception as e:
+                item.error = e
+            item.done = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        if exc[0] is None:
+            self.flush()
+
+class HTTPConnection(http.client.HTTPConnection):
+    """ http.client sends headers and body separately, so turn off Nagle's algorithm """
+    def connect(self):
+        http.client.HTTPConnection.connect(self)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+class HTTPSConnection(http.client.HTTPSConnection):
+    def connect(self):
+        http.client.HTTPSConnection.connect(self)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+class PooledResponse:
+    """ file-like response, hands the connection back to the pool on close """
+    def __init__(self, pool, key, conn, response, url):
+        self.pool = pool
+        self.key = key
+        self.conn = conn
+        self.response = response
+        self.url = url
+        self.status = response.status
+        self.reason = response.reason
+        self.headers = response.headers
+        self.received = 0 # bytes read, after decompression
+        self.body = response
+        encoding = wire.encoding_for(response.getheader('content-encoding'))
+        if encoding is not None:
+            self.body = io.BufferedReader(wire.DecodedFile(response, encoding.decompressobj()), wire.CHUNK_SIZE)
+
+    def getheader(self, name, default=None):
+        return self.response.getheader(name, default)
+
+    def read(self, amt=None):
+        data = self.body.read() if amt is None else self.body.read(amt)
+        self.received += len(data)
+        return data
+
+    def read1(self, amt=-1):
+        data = self.body.read1(amt)
+        self.received += len(data)
+        return data
+
+    def readline(self, limit=-1):
+        data = self.body.readline(limit)
+        self.received += len(data)
+        return data
+
+    def close(self):
+        conn, self.conn = self.conn, None
+        if conn is None:
+            return
+        if self.response.isclosed() and not self.response.will_close:
+            self.pool.release(self.key, conn)
+        else:
+            self.response.close()
+            conn.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class ConnectionPool:
+    """
+        persistent HTTP/1.1 connections, kept per (scheme, host, port)
+
+        at most maxsize idle connections are kept for each key, and ones idle
+        for longer than idle_timeout seconds are discarded. a request that
+        finds no idle connection opens a new one, rather than waiting
+    """
+    Connections = {'http': HTTPConnection, 'https': HTTPSConnection}
+    Redirects = (301, 302, 303, 307, 308)
+    Idempotent = ('GET', 'HEAD') # safe to send again when a reused connection fails
+
+    def __init__(self, maxsize=4, idle_timeout=30, timeout=None, max_redirects=10):
+        self.maxsize = maxsize
+        self.idle_timeout = idle_timeout
+        self.timeout = timeout
+        self.max_redirects = max_redirects
+        self.lock = threading.Lock()
+        self.idle = {}
+
+    def connect(self, key):
+        scheme, host, port = key
+        Connection = self.Connections[scheme]
+        if self.timeout is None:
+            return Connection(host, port)
+        return Connection(host, port, timeout=self.timeout)
+
+    def checkout(self, key):
+        now = time.monotonic()
+        stale = []
+        conn = None
+        with self.lock:
+            idle = self.idle.get(key)
+            while idle:
+                c, last_used = idle.pop()
+                if now - last_used < self.idle_timeout:
+                    conn = c
+                    break
+                stale.append(c)
+        for c in stale:
+            c.close()
+        return conn
+
+    def release(self, key, conn):
+        with self.lock:
+            idle = self.idle.setdefault(key, [])
+            if len(idle) < self.maxsize:
+                idle.append((conn, time.monotonic()))
+                return
+        conn.close()
+
+    def close(self):
+        with self.lock:
+            idle, self.idle = self.idle, {}
+        for conns in idle.values():
+            for conn, last_used in conns:
+                conn.close()
+
+    def open(self, method, url, body=None, headers=None):
+        parts = urlsplit(url)
+        if parts.scheme not in self.Connections:
+            raise ValueError("unsupported url: {}".format(url))
+        key = (parts.scheme, parts.hostname, parts.port)
+        path = parts.path or '/'
+        if parts.query:
+            path = '{}?{}'.format(path, parts.query)
+        headers = headers or {}
+
+        conn = self.checkout(key)
+        if conn is not None:
+            try:
+                conn.request(method, path, body, headers)
+            except ConnectionError:
+                conn.close() # closed by the server while idle, so retry once
+            else:
+                try:
+                    return PooledResponse(self, key, conn, conn.getresponse(), url)
+                except (ConnectionError, http.client.BadStatusLine):
+                    conn.close()
+                    # the server may have run the request before closing
+                    if method not in self.Idempotent:
+                        raise
+
+        conn = self.connect(key)
+        try:
+            conn.request(method, path, body, headers)
+            return PooledResponse(self, key, conn, conn.getresponse(), url)
+        except:
+            conn.close()
+            raise
+
+    def urlopen(self, method, url, body=None, headers=None):
+        """ like urllib.request.urlopen: follows redirects, raises HTTPError """
+        headers = dict(headers or {})
+        for _ in range(self.max_redirects + 1):
+            fh = self.open(method, url, body, headers)
+            if fh.status in self.Redirects and fh.getheader('location'):
+                fh.read()
+                fh.close()
+                url = urljoin(url, fh.getheader('location'))
+                if fh.status in (301, 302, 303) and method != 'HEAD':
+                    method, body = 'GET', None
+                    headers = {k:v for k,v in headers.items() if k.lower() != 'content-type'}
+                continue
+            if not 200 <= fh.status < 300:
+                data = fh.read()
+                fh.close()
+                raise urllib.error.HTTPError(url, fh.status, fh.reason, fh.headers, io.BytesIO(data))
+            return fh
+        raise urllib.error.HTTPError(url, fh.status, 'too many redirects', fh.headers, None)
+
 class Session:
-    def __init__(self):
-        pass
+    prefetch = 0 # pages to fetch ahead when iterating, see ResultSet.prefetch
+    page_size = None # limit for each page when iterating, the server's choice by default
+    max_poll_seconds = 10 # longest wait between polls of a FutureResult
+    columns = True # ask for EntrySets as rows, rather than embedded entries
+
+    def __init__(self, pool=None, prefetch=0, page_size=None):
+        self.pool = pool if pool is not None else ConnectionPool()
+        self.prefetch = prefetch
+        self.page_size = page_size
+        self.servers = {} # url_origin -> (content_type, content_encoding), see negotiated
+
+    def negotiated(self, url):
+        """
+            the content type and encoding for request bodies sent to url's
+            server, following that server's responses: the codec it answered
+            with, and an encoding once it has compressed a response
+        """
+        return self.servers.get(wire.url_origin(url), (wire.CONTENT_TYPE, None))
+
+    def learn(self, url, content_type, content_encoding):
+        codec = wire.codec_for(content_type)
+        encoding = wire.encoding_for(content_encoding)
+        if codec or encoding:
+            old_type, old_encoding = self.negotiated(url)
+            self.servers[wire.url_origin(url)] = (
+                codec.content_type if codec else old_type,
+                encoding.name if encoding else old_encoding)
+
+    def decode_response(self, fh):
+        content_type = fh.getheader('content-type')
+        self.learn(fh.url, content_type, fh.getheader('content-encoding'))
+        return wire.decode_file(fh, content_type)
 
     def raw_request(self, request, base_url=None, cached=None):
-        headers = {'Accept': wire.CONTENT_TYPE}
+        headers = {'Accept': wire.accept_header(), 'Accept-Encoding': wire.accept_encoding_header()}
         if isinstance(request, str):
             request = wire.HTTPRequest("GET", request, {}, headers, None, None, cached)
         elif isinstance(request, wire.Request):
-            request = request.make_http(base_url)
+            request = request.make_http(base_url, self.negotiated(urljoin(base_url or '', request.path))[0])
 
         obj = request.cached
 
@@ -130,30 +545,54 @@ class Session:
                 headers.update(request.headers)
             if request.params:
                 url = '{}?{}'.format(url, urlencode(request.params))
-            urllib_request= urllib.request.Request(
-                url=url,
-                data=request.data,
-                method=request.method,
-                headers=headers
-            )
-
-            with urllib.request.urlopen(urllib_request) as fh:
-                return fh.url, wire.decode_file(fh, fh.getheader('content-type'))
+            data = request.data
+            encoding = wire.encoding_for(self.negotiated(url)[1])
+            if encoding and data and len(data) >= wire.COMPRESS_MIN_SIZE:
+                data = b''.join(encoding.compress_iter([data]))
+                headers['Content-Encoding'] = encoding.name
+            fh = self.pool.urlopen(request.method, url, data, headers)
+            try:
+                obj = self.decode_response(fh)
+            except BaseException:
+                fh.close()
+                raise
+            if not isinstance(obj, wire.Stream):
+                fh.close() # streams close the response once read
+                if obj is not None:
+                    obj.received = fh.received
+            return fh.url, obj
         else:
             return request.url, wire.decode_object(obj)
 
+    def revalidate(self, url, etag=None):
+        """ conditional GET, returns (url, etag, obj), obj is None when unchanged """
+        headers = {'Accept': wire.accept_header(), 'Accept-Encoding': wire.accept_encoding_header()}
+        if etag:
+            headers['If-None-Match'] = etag
+        try:
+            with self.pool.urlopen("GET", url, None, headers) as fh:
+                obj = self.decode_response(fh)
+                return fh.url, fh.getheader('etag'), obj
+        except urllib.error.HTTPError as e:
+            if e.code == 304:
+                return url, etag, None
+            raise
+
     def request(self, request, base_url= None):
-        """ Handle redirects, futures """
+        """ Handle redirects, futures, waiting between polls as the server asks """
         url = base_url
+        polls = 0
         while True:
             url, result = self.raw_request(request, url)
             if isinstance(result, wire.FutureResult):
+                time.sleep(result.poll_delay(polls, self.max_poll_seconds))
+                polls += 1
                 request = result.make_request()
             else:
                 return url, result
 
-def open(request, schema=None):
-    session = Session()
+def open(request, schema=None, session=None):
+    session = session or Session()
     url, response = session.request(request)
     return APIClient.wrap(response, url, session)
 
@@ -1,16 +1,314 @@
 import types
-import os, sys, uuid
+import os, sys, uuid, json
+import hashlib, importlib, collections
+import contextlib, functools, itertools, operator
+import queue, threading, time, warnings
+from concurrent.futures import Future, wait
+import datetime, decimal
 from urllib.parse import urljoin, urlencode
 
 from . import wire
+from .errors import Error
 from .server import App, ModelEndpoint, funcargs, rpc
 
-from peewee import Database, Model
-from playhouse.reflection import Introspector
-from playhouse.db_url import connect as db_connect
+import peewee
+from peewee import Database, Model, ForeignKeyField, chunked
+from peewee import SqliteDatabase, PostgresqlDatabase, MySQLDatabase
+from peewee import AutoField, BigAutoField, IntegerField, BigIntegerField, SmallIntegerField
+from peewee import FloatField, DoubleField, CharField, FixedCharField, TextField
+from playhouse.reflection import Introspector, DatabaseMetadata, Column, UnknownField
+from playhouse.db_url import connect as db_connect, schemes as db_schemes
+from playhouse.pool import PooledDatabase
 
+# fields whose database values go on the wire as they are
+PLAIN_FIELDS = (
+    AutoField, BigAutoField, IntegerField, BigIntegerField, SmallIntegerField,
+    FloatField, DoubleField, CharField, FixedCharField, TextField,
+)
+
+def wire_value(value):
+    if isinstance(value, uuid.UUID):
+        return value.hex
+    elif isinstance(value, (datetime.datetime, datetime.date, datetime.time)):
+        return value.isoformat()
+    elif isinstance(value, decimal.Decimal):
+        return str(value)
+    elif isinstance(value, (bytes, bytearray, memoryview)):
+        return bytes(value).hex()
+    return value
+
+def converter_for(field):
+    """ a function from a database or python value to a wire value, or None if it goes as is """
+    while isinstance(field, ForeignKeyField):
+        field = field.rel_field
+    if type(field) in PLAIN_FIELDS:
+        return None
+    python_value = field.python_value
+    def convert(value):
+        if value is None:
+            return None
+        return wire_value(python_value(value))
+    return convert
+
+class SelectorError(Error):
+    pass
+
+class UnindexedSelectorWarning(UserWarning):
+    """ a selector that scans a large table, see PeeweeEndpoint.unindexed """
+
+class Selector:
+    """
+        selectors are json, fields are and-ed together, and so is a list of selectors
+
+            {"name": "bob", "age": {">=": 18, "<": 65}}
+            {"job": {"in": ["a", "b"]}, "name": {"prefix": "b"}}
+            {"$or": [{"job": "a"}, {"name": "bob"}]}, {"$and": [...]}, {"$not": {...}}
+
+        parse them with parse_selector, which caches them
+    """
+    Operators = ('=', '!=', '<', '<=', '>', '>=', 'in', 'prefix')
+
+    def __init__(self, op, field=None, value=None, items=()):
+        self.op = op
+        self.field = field
+        self.value = value
+        self.items = list(items)
+
+    @classmethod
+    def parse(cls, obj):
+        if isinstance(obj, list):
+            return cls('and', items=[cls.parse(o) for o in obj])
+        if not isinstance(obj, dict):
+            raise SelectorError("expecting an object or a list: {!r}".format(obj))
+
+        items = []
+        for key, value in obj.items():
+            if key in ('$and', '$or'):
+                if not isinstance(value, list):
+                    raise SelectorError("{} takes a list".format(key))
+                items.append(cls(key[1:], items=[cls.parse(v) for v in value]))
+            elif key == '$not':
+                items.append(cls('not', items=[cls.parse(value)]))
+            elif key.startswith('$'):
+                raise SelectorError("unknown operator: {}".format(key))
+            elif isinstance(value, dict):
+                for op, v in value.items():
+                    if op not in cls.Operators:
+                        raise SelectorError("unknown operator: {}".format(op))
+                    if op == 'in' and not isinstance(v, list):
+                        raise SelectorError("in takes a list")
+                    if op == 'prefix' and not isinstance(v, str):
+                        raise SelectorError("prefix takes a string")
+                    items.append(cls(op, key, v))
+            else:
+                items.append(cls('=', key, value))
+        return items[0] if len(items) == 1 else cls('and', items=items)
+
+    def dump(self):
+        if self.op in ('and', 'or'):
+            return {'$' + self.op: [i.dump() for i in self.items]}
+        elif self.op == 'not':
+            return {'$not': self.items[0].dump()}
+        return {self.field: {self.op: self.value}}
+
+    def compile(self, fields):
+        """ a peewee expression, or None when there's nothing to filter on """
+        if self.op in ('and', 'or'):
+            exprs = [e for e in (i.compile(fields) for i in self.items) if e is not None]
+            if not exprs:
+                return None
+            return functools.reduce(operator.and_ if self.op == 'and' else operator.or_, exprs)
+        elif self.op == 'not':
+            expr = self.items[0].compile(fields)
+            return ~expr if expr is not None else None
+
+        field = fields.get(self.field)
+        if field is None:
+            raise SelectorError("unknown field: {}".format(self.field))
+        op, value = self.op, self.value
+        if op == '=':
+            return field.is_null() if value is None else field == value
+        elif op == '!=':
+            return field.is_null(False) if value is None else field != value
+        elif op == '<':
+            return field < value
+        elif op == '<=':
+            return field <= value
+        elif op == '>':
+            return field > value
+        elif op == '>=':
+            return field >= value
+        elif op == 'in':
+            return field.in_(value)
+        elif op == 'prefix':
+            # a range rather than LIKE, so an index on the field can be used
+            if not value:
+                return field.is_null(False)
+            last = ord(value[-1]) + 1
+            if last > 0x10FFFF or 0xD800 <= last <= 0xDFFF:
+                # no next character to end the range with
+                return (field >= value) & field.startswith(value)
+            return (field >= value) & (field < value[:-1] + chr(last))
+
+    def indexed(self, indexes):
+        """ can every row be found through an index, rather than a scan """
+        if self.op == 'and':
+            return any(i.indexed(indexes) for i in self.items)
+        elif self.op == 'or':
+            return bool(self.items) and all(i.indexed(indexes) for i in self.items)
+        elif self.op == 'not':
+            return False
+        return self.op != '!=' and self.field in indexes
+
+    def empty(self):
+        return self.op in ('and', 'or') and all(i.empty() for i in self.items)
+
+@functools.lru_cache(maxsize=512)
+def parse_selector(text):
+    """ text is json, see Selector """
+    try:
+        obj = json.loads(text)
+    except ValueError as e:
+        raise SelectorError("bad selector: {}".format(e))
+    return Selector.parse(obj)
+
+# for sqlite under connect_database: readers don't wait for writers, and share pages through mmap
+SQLITE_PRAGMAS = {
+    'journal_mode': 'wal',
+    'synchronous': 'full', # every commit waits for fsync, see connect_database
+    'mmap_size': 256 * 1024 * 1024,
+    'cache_size': -64 * 1024, # KiB, per connection
+    'busy_timeout': 5000, # ms
+}
+
+def connect_database(url, pool=True, max_connections=32, timeout=10, stale_timeout=300, synchronous=None):
+    """
+        like playhouse.db_url.connect, but pooled, waiting up to timeout
+        seconds for a free connection, and with SQLITE_PRAGMAS for sqlite.
+
+        synchronous='normal' makes sqlite commits skip the fsync, so they
+        are faster, but the last few may be lost if the machine crashes
+
+        PeeweeEndpoint checks a pooled connection out for each request
+    """
+    scheme, sep, rest = url.partition('://')
+    params = {}
+    if scheme.split('+')[0] in ('sqlite', 'cysqlite'):
+        params['pragmas'] = dict(SQLITE_PRAGMAS)
+        if synchronous:
+            params['pragmas']['synchronous'] = synchronous
+        if ':memory:' in rest or rest in ('', '/'):
+            pool = False # every connection would get its own database
+    if pool and not scheme.endswith('+pool') and scheme + '+pool' in db_schemes:
+        scheme = scheme + '+pool'
+        params.update(max_connections=max_connections, timeout=timeout, stale_timeout=stale_timeout)
+    if 'pragmas' in params and scheme.endswith('+pool'):
+        params['check_same_thread'] = False # a pooled connection moves between threads, one at a time
+    return db_connect(scheme + sep + rest, **params)
+
+class GroupCommit:
+    """
+        one writer thread per database, committing queued writes together.
+
+        each write runs in a savepoint of the shared transaction, so a
+        failing write only fails its own caller. a batch is whatever queued
+        while the last one committed, waiting up to window seconds for more,
+        and no more than max_batch writes. the thread starts on first use,
+        so after a fork each worker gets its own, and if it dies, its batch
+        fails and waiting callers start another
+    """
+    writers = {}
+    lock = threading.Lock()
+    check_seconds = 1 # how often waiting callers check the writer is alive
+
+    @classmethod
+    def for_database(cls, database):
+        with cls.lock:
+            writer = cls.writers.get(id(database))
+            if writer is None or writer.database is not database:
+                writer = cls.writers[id(database)] = cls(database)
+            return writer
+
+    def __init__(self, database, window=0.0, max_batch=256):
+        self.database = database
+        self.window = window
+        self.max_batch = max_batch
+        self.queue = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def run(self, fn, *args):
+        """ called from request threads, blocks until fn has been committed """
+        future = Future()
+        self.queue.put((future, fn, args))
+        while not future.done():
+            self.start()
+            wait([future], timeout=self.check_seconds)
+        return future.result()
+
+    def start(self):
+        with self.lock:
+            if self.thread is None or not self.thread.is_alive():
+                self.thread = threading.Thread(target=self.loop, name='trpc-group-commit', daemon=True)
+                self.thread.start()
+
+    def loop(self):
+        batch = []
+        try:
+            while True:
+                batch = [self.queue.get()]
+                deadline = time.monotonic() + self.window
+                while len(batch) < self.max_batch:
+                    try:
+                        timeout = deadline - time.monotonic()
+                        if timeout > 0:
+                            batch.append(self.queue.get(timeout=timeout))
+                        else:
+                            batch.append(self.queue.get_nowait())
+                    except queue.Empty:
+                        break
+                self.commit(batch)
+        except BaseException as e:
+            for future, fn, args in batch:
+                if not future.done():
+                    future.set_exception(e)
+            raise
+
+    def commit(self, batch):
+        results = []
+        try:
+            # pooled connections are checked out per batch, not kept by the writer
+            pooled = isinstance(self.database, PooledDatabase)
+            self.database.connect(reuse_if_open=True)
+            try:
+                with self.database.atomic():
+                    for future, fn, args in batch:
+                        try:
+                            with self.database.atomic():
+                                results.append((future, fn(*args), None))
+                        except Exception as e:
+                            results.append((future, None, e))
+            finally:
+                if pooled:
+                    self.database.close()
+        except Exception as e:
+            for future, fn, args in batch:
+                future.set_exception(e)
+            return
+        for future, value, error in results:
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(value)
 
 class PeeweeEndpoint(ModelEndpoint):
+    max_variables = 999 # bound parameters per statement, sqlite's oldest limit
+    unindexed = 'warn' # or 'reject' or 'allow', for selectors that scan tables over scan_rows
+    scan_rows = 10000
+    fetch_size = 500 # rows read per query while a page is written out
+    group_commit = False # queue create_entry and delete_entry for a GroupCommit writer
+    supports_columns = True
+
     def __init__(self, app, prefix, name,  model):
         ModelEndpoint.__init__(self, app, prefix, name, model)
 
@@ -20,6 +318,23 @@ class PeeweeEndpoint(ModelEndpoint):
         self.create_fields = list(k for k,v in self.fields.items() if not v.primary_key)
         self.indexes = [self.key]
         self.indexes.extend(k for k,v in self.fields.items() if v.index or v.unique) 
+        self.expressions = {} # Selector -> peewee expression
+        self.scans = {} # Selector -> message when it scans over scan_rows, else None
+        self.names = list(self.fields)
+        self.columns = [self.fields[name] for name in self.names]
+        self.converters = [converter_for(f) for f in self.columns]
+        self.key_index = self.names.index(self.key)
+
+    def handle_trpc_request(self, route, request):
+        with self.connection():
+            return ModelEndpoint.handle_trpc_request(self, route, request)
+
+    def connection(self):
+        """ a pooled connection returned to the pool afterwards, if this thread has none open """
+        database = self.model._meta.database
+        if not isinstance(database, PooledDatabase) or not database.is_closed():
+            return contextlib.nullcontext()
+        return database.connection_context()
 
     def describe_model(self):
         return wire.Model(
@@ -38,9 +353,29 @@ class PeeweeEndpoint(ModelEndpoint):
         return self.describe_entry(obj)
 
     def create_entry(self, data):
+        if self.group_commit:
+            return GroupCommit.for_database(self.model._meta.database).run(self.create_one, data)
+        return self.create_one(data)
+
+    def create_one(self, data):
         obj = self.model.create(**data)
         return self.describe_entry(obj)
 
+    def create_many(self, items):
+        """ one transaction for every item, and one insert for each chunk that fits in max_variables """
+        if not all(isinstance(i, dict) for i in items):
+            raise wire.HTTPResponse('400 items must be objects', [], [])
+        unknown = set().union(*items).difference(self.fields)
+        if unknown:
+            raise wire.HTTPResponse('400 unknown fields', [], [", ".join(sorted(unknown)).encode('utf-8')])
+        size = max(1, self.max_variables // len(self.fields))
+        with self.model._meta.database.atomic():
+            # an insert takes its columns from the first row, so rows are grouped by their fields
+            for _, rows in itertools.groupby(items, key=lambda i: sorted(i)):
+                for chunk in chunked(rows, size):
+                    self.model.insert_many(chunk).execute()
+        return len(items)
+
     def update_entry(self, key, data):
         pass
 
@@ -48,85 +383,377 @@ class PeeweeEndpoint(ModelEndpoint):
         pass
 
     def delete_entry(self, name):
+        if self.group_commit:
+            return GroupCommit.for_database(self.model._meta.database).run(self.delete_one, name)
+        return self.delete_one(name)
+
+    def delete_one(self, name):
         self.model.delete().where(self.pk == name).execute()
 
+    def delete_many(self, keys):
+        count = 0
+        with self.model._meta.database.atomic():
+            for chunk in chunked(keys, self.max_variables):
+                count += self.model.delete().where(self.pk.in_(chunk)).execute()
+        return count
+
     def watch_entry(self, key): 
         pass
 
-    def get_where(self, selector, state, limit):
+    def get_where(self, selector, state, limit, columns=False):
         next = state
-        items = self.model.select()
+        items = self.model.select(*self.columns)
         pk = self.pk
         next_token = None
-        if selector:
+        selector = self.parse_selector(selector)
+        if selector is not None:
+            if not next:
+                self.check_indexed(selector) # once, on the first page
             items = self.select_on(items, selector)
 
-        if limit or next:
-            items = items.order_by(pk)
-            if next:
-                items = items.where(pk > next)
-            if limit:
-                items = items.limit(limit)
+        # pages are never larger than App.max_page_size, whatever the client asks for
+        # and never smaller than one, sqlite reads LIMIT -1 as no limit at all
+        if limit is None:
+            limit = self.app.max_page_size
+        else:
+            try:
+                limit = max(1, min(int(limit), self.app.max_page_size))
+            except (TypeError, ValueError):
+                raise wire.HTTPResponse('400 bad limit', [], [repr(limit).encode('utf-8')])
 
-            items = list(items)
-            if items:
-                next_token = self.key_for(items[-1])
+        items = items.order_by(pk)
+        if next:
+            items = items.where(pk > next)
+        # the key of the last row goes first in the response, ahead of the rows
+        last = items.select(pk).offset(limit - 1).limit(1)
+        last = self.model._meta.database.execute(last).fetchone()
+        if last is not None:
+            convert = self.converters[self.key_index]
+            next_token = convert(last[0]) if convert is not None else last[0]
+            items = items.where(pk <= last[0])
+        rows = self.fetch_rows(items)
 
-        items = [self.describe_entry(o).embed() for o in items]
+        if columns:
+            return wire.EntrySet(
+                name=self.name,
+                items=self.convert_rows(rows),
+                selector=selector.dump() if selector is not None else None,
+                next='list' if next_token is not None else None,
+                state=next_token,
+                columns=self.names,
+                shared=wire.Entry(attributes=None).embed()['metadata'],
+            )
 
         return wire.EntrySet(
             name=self.name, 
-            selector={}, # dom.dump_selector(selector),
-            items=items,
-            next=next_token
+            selector=selector.dump() if selector is not None else None,
+            items=self.embed_rows(rows),
+            next='list' if next_token is not None else None,
+            state=next_token,
+        )
+
+    def fetch_rows(self, items):
+        """
+            rows a few at a time, with a query for every fetch_size, as the
+            response is written. under asgi each chunk may come from another
+            thread, so no cursor or connection is held between them
+        """
+        database, after = self.model._meta.database, None
+        while True:
+            query = items if after is None else items.where(self.pk > after)
+            with self.connection():
+                rows = database.execute(query.limit(self.fetch_size)).fetchall()
+            yield from rows
+            if len(rows) < self.fetch_size:
+                return
+            after = rows[-1][self.key_index]
+
+    def convert_row(self, row):
+        row = list(row)
+        for i, convert in enumerate(self.converters):
+            if convert is not None:
+                row[i] = convert(row[i])
+        return row
+
+    def convert_rows(self, rows):
+        converters = [(i, c) for i, c in enumerate(self.converters) if c is not None]
+        if not converters:
+            yield from rows
+            return
+        for row in rows:
+            row = list(row)
+            for i, convert in converters:
+                row[i] = convert(row[i])
+            yield row
+
+    def embed_rows(self, rows):
+        """ embedded Entries, straight from database rows, without making model instances """
+        names = self.names
+        template = wire.Entry(attributes=None).embed()
+        kind, api_version, metadata = template['kind'], template['apiVersion'], template['metadata']
+        for row in self.convert_rows(rows):
+            yield {'kind': kind, 'apiVersion': api_version, 'metadata': metadata, 'attributes': dict(zip(names, row))}
+
+    def explain_where(self, selector):
+        selector = self.parse_selector(selector)
+        items = self.model.select()
+        if selector is not None:
+            items = self.select_on(items, selector)
+        items = items.order_by(self.pk).limit(self.app.max_page_size)
+        sql, params = items.sql()
+
+        database = self.model._meta.database
+        prefix = 'EXPLAIN QUERY PLAN ' if 'sqlite' in type(database).__name__.lower() else 'EXPLAIN '
+        try:
+            plan = [[str(c) for c in row] for row in database.execute_sql(prefix + sql, params).fetchall()]
+        except Exception as e:
+            plan = [[repr(e)]]
+
+        return dict(
+            selector=selector.dump() if selector is not None else None,
+            indexed=selector is None or selector.indexed(self.indexes),
+            indexes=self.indexes,
+            sql=sql,
+            params=[str(p) for p in params],
+            plan=plan,
         )
 
+    def parse_selector(self, selector):
+        """ None for no selector, raises a 400 for a bad one """
+        if not selector:
+            return None
+        try:
+            selector = parse_selector(json.dumps(selector, sort_keys=True))
+            self.compile_selector(selector) # check the fields now, not halfway through a query
+        except SelectorError as e:
+            raise wire.HTTPResponse('400 bad selector', [], [str(e).encode('utf-8')])
+        return None if selector.empty() else selector
+
+    def check_indexed(self, selector):
+        """ counts the table once for each selector, and warns once """
+        if self.unindexed == 'allow' or selector.indexed(self.indexes):
+            return
+        if selector in self.scans:
+            message = self.scans[selector]
+        else:
+            message = None
+            rows = self.model.select().limit(self.scan_rows + 1).count()
+            if rows > self.scan_rows:
+                message = "selector {} on {} scans over {} rows, indexes are {}".format(
+                    json.dumps(selector.dump()), self.name, self.scan_rows, ", ".join(self.indexes))
+                if self.unindexed != 'reject':
+                    warnings.warn(message, UnindexedSelectorWarning)
+            if len(self.scans) >= 512:
+                self.scans.clear()
+            self.scans[selector] = message
+        if message and self.unindexed == 'reject':
+            raise wire.HTTPResponse('400 selector needs an index', [], [message.encode('utf-8')])
+
     def delete_where(self, selector):
+        selector = self.parse_selector(selector)
+        if selector is None:
+            raise wire.HTTPResponse('400 delete needs a selector', [], [])
         self.select_on(self.model.delete(), selector).execute()
 
     def watch_where(self, selector, cursor=None): 
         pass
 
     def extract_attributes(self, obj):
-        attr = dict()
-        for name in self.fields:
-            a = getattr(obj, name)
-            if isinstance(a, uuid.UUID):
-                a = a.hex
-            attr[name] = a
-        return attr
+        data = obj.__data__
+        return dict(zip(self.names, self.convert_row(data.get(name) for name in self.names)))
 
     def key_for(self, obj):
-        name = self.pk.name
-        attr = getattr(obj, name)
-        if isinstance(attr, uuid.UUID):
-            attr = attr.hex
-        return attr
+        value = obj.__data__.get(self.key)
+        convert = self.converters[self.key_index]
+        return convert(value) if convert is not None and value is not None else value
 
     def select_on(self, items, selector):
-        for s in selector:
-            key, operator, values = s.key, s.__class__, s.value
-            field = self.fields[key]
-            if operator == dom.Operator.Equals:
-                items = items.where(field == values)
-            elif operator == dom.Operator.NotEquals:
-                items = items.where(field != values)
-            else:
-                raise Exception('unsupported')
+        if not isinstance(selector, Selector):
+            selector = Selector.parse(selector)
+        expr = self.compile_selector(selector)
+        if expr is not None:
+            items = items.where(expr)
         return items
 
+    def compile_selector(self, selector):
+        """ peewee expressions are kept for each parsed selector, see parse_selector """
+        if selector in self.expressions:
+            return self.expressions[selector]
+        expr = selector.compile(self.fields)
+        if len(self.expressions) >= 512:
+            self.expressions.clear()
+        self.expressions[selector] = expr
+        return expr
+
+# queries whose results change whenever the tables, columns, indexes or keys do
+FINGERPRINT_QUERIES = (
+    (SqliteDatabase, (
+        "SELECT type, name, tbl_name, sql FROM sqlite_master ORDER BY type, name",
+    )),
+    (PostgresqlDatabase, (
+        "SELECT table_name, column_name, data_type, is_nullable, column_default FROM information_schema.columns"
+        " WHERE table_schema = current_schema() ORDER BY table_name, ordinal_position",
+        "SELECT tablename, indexname, indexdef FROM pg_indexes WHERE schemaname = current_schema() ORDER BY 1, 2",
+        "SELECT conrelid::regclass::text, conname, pg_get_constraintdef(oid) FROM pg_constraint"
+        " WHERE connamespace = current_schema()::regnamespace ORDER BY 1, 2",
+    )),
+    (MySQLDatabase, (
+        "SELECT table_name, column_name, column_type, is_nullable, column_default FROM information_schema.columns"
+        " WHERE table_schema = DATABASE() ORDER BY table_name, ordinal_position",
+        "SELECT table_name, index_name, seq_in_index, column_name, non_unique FROM information_schema.statistics"
+        " WHERE table_schema = DATABASE() ORDER BY 1, 2, 3",
+        "SELECT table_name, constraint_name, column_name, referenced_table_name, referenced_column_name"
+        " FROM information_schema.key_column_usage WHERE table_schema = DATABASE() ORDER BY 1, 2, 3",
+    )),
+)
+
+def schema_fingerprint(db):
+    """ a hash of the database's schema, or None for databases without FINGERPRINT_QUERIES """
+    for cls, queries in FINGERPRINT_QUERIES:
+        if isinstance(db, cls):
+            h = hashlib.sha256()
+            for query in queries:
+                for row in db.execute_sql(query).fetchall():
+                    h.update(repr(tuple(row)).encode('utf-8'))
+            return h.hexdigest()
+
+def dump_metadata(metadata):
+    """ playhouse DatabaseMetadata as json, see load_metadata """
+    def column(c):
+        fk = getattr(c, 'foreign_key', None)
+        return dict(
+            name=c.name, field_class=field_class_name(c.field_class), raw_column_type=c.raw_column_type,
+            nullable=c.nullable, primary_key=c.primary_key, column_name=c.column_name,
+            index=c.index, unique=c.unique, default=c.default, extra_parameters=c.extra_parameters,
+            foreign_key=fk._asdict() if fk is not None else None,
+            rel_model=c.rel_model, related_name=c.related_name, to_field=c.to_field,
+        )
+    return dict(
+        columns={t: [[k, column(c)] for k, c in cols.items()] for t, cols in metadata.columns.items()},
+        primary_keys=metadata.primary_keys,
+        foreign_keys={t: [fk._asdict() for fk in fks] for t, fks in metadata.foreign_keys.items()},
+        model_names=metadata.model_names,
+        indexes={t: [i._asdict() for i in idx] for t, idx in metadata.indexes.items()},
+    )
+
+def load_metadata(obj):
+    def column(c):
+        out = Column(c['name'], field_class_for(c['field_class']), c['raw_column_type'], c['nullable'],
+            c['primary_key'], c['column_name'], c['index'], c['unique'], c['default'], c['extra_parameters'])
+        if c['foreign_key'] is not None:
+            out.foreign_key = peewee.ForeignKeyMetadata(**c['foreign_key'])
+        out.rel_model, out.related_name, out.to_field = c['rel_model'], c['related_name'], c['to_field']
+        return out
+    return DatabaseMetadata(
+        {t: collections.OrderedDict((k, column(c)) for k, c in cols) for t, cols in obj['columns'].items()},
+        obj['primary_keys'],
+        {t: [peewee.ForeignKeyMetadata(**fk) for fk in fks] for t, fks in obj['foreign_keys'].items()},
+        obj['model_names'],
+        {t: [peewee.IndexMetadata(**i) for i in idx] for t, idx in obj['indexes'].items()},
+    )
+
+def field_class_name(cls):
+    return "{}:{}".format(cls.__module__, cls.__qualname__)
+
+def field_class_for(name):
+    """ only field classes from peewee and playhouse, whatever the cache file says """
+    module, _, qualname = name.partition(':')
+    if module != 'peewee' and not module.startswith('playhouse.'):
+        raise ValueError("not a peewee field: {}".format(name))
+    cls = getattr(importlib.import_module(module), qualname, None)
+    if not (isinstance(cls, type) and (issubclass(cls, peewee.Field) or cls is UnknownField)):
+        raise ValueError("not a peewee field: {}".format(name))
+    return cls
+
+class ModelCache:
+    """
+        keeps introspected models (as playhouse DatabaseMetadata, in json) on
+        disk, so python -m trpc.db restarts against an unchanged database
+        skip introspection.
+
+        there's one file per database url, used while the schema_fingerprint,
+        the peewee version, and this module's code, match. like
+        cli.SchemaCache, $TRPC_CACHE_DIR overrides the directory
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    @classmethod
+    def from_environ(cls, environ):
+        path = environ.get('TRPC_CACHE_DIR')
+        if not path:
+            base = environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+            path = os.path.join(base, 'trpc')
+        return cls(path)
+
+    @functools.cached_property
+    def code_hash(self):
+        with open(__file__, 'rb') as fh:
+            return hashlib.sha256(fh.read()).hexdigest()
+
+    def filename(self, url):
+        name = hashlib.sha1(url.encode('utf-8')).hexdigest()
+        return os.path.join(self.path, "db-{}.json".format(name))
+
+    def load(self, filename, key):
+        try:
+            with open(filename) as fh:
+                entry = json.load(fh)
+            if entry.get('key') == key:
+                return load_metadata(entry['metadata'])
+        except (OSError, ValueError, KeyError, TypeError):
+            return None
+
+    def save(self, filename, key, metadata):
+        tmp = "{}.{}".format(filename, os.getpid())
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            with open(tmp, 'w') as fh:
+                json.dump(dict(key=key, metadata=dump_metadata(metadata)), fh)
+            os.replace(tmp, filename)
+        except (OSError, ValueError, TypeError):
+            pass
+        finally:
+            if os.path.exists(tmp): # a half written file, after a failed dump
+                try:
+                    os.unlink(tmp)
+                except OSError:
+                    pass
+
+    def generate_models(self, db, url):
+        introspector = Introspector.from_database(db)
+        fingerprint = schema_fingerprint(db)
+        if fingerprint is None:
+            return introspector.generate_models()
+
+        filename = self.filename(url) # the url isn't saved, it may have a password in it
+        key = [fingerprint, peewee.__version__, self.code_hash]
+        metadata = self.load(filename, key)
+        if metadata is None:
+            metadata = introspector.introspect()
+            self.save(filename, key, metadata)
+
+        # generate_models introspects first, so hand it the cached metadata instead
+        introspector.introspect = lambda *args, **kwargs: metadata
+        return introspector.generate_models()
+
 if __name__ == '__main__':
     Model.make_trpc_endpoint=PeeweeEndpoint
 
     url = os.environ.get("DATABASE_URL","sqlite:///trpc.db")
+    if os.environ.get("TRPC_GROUP_COMMIT"):
+        PeeweeEndpoint.group_commit = True
 
-    db = db_connect(url)
-    db.connect()
+    db = connect_database(url, synchronous=os.environ.get("TRPC_SQLITE_SYNCHRONOUS"))
 
-    introspector = Introspector.from_database(db)
-    endpoints = introspector.generate_models()
-    database = introspector.introspect()
+    endpoints = ModelCache.from_environ(os.environ).generate_models(db, url)
 
+    # requests check out their own connections, and none are shared with forked workers
+    if isinstance(db, PooledDatabase):
+        db.close_all()
+    else:
+        db.close()
 
     app = App('Database', endpoints)
     app.main()
@@ -3,7 +3,19 @@ import traceback
 import sys
 import os
 import inspect
-
+import hashlib
+import asyncio
+import json
+import threading
+import time
+import uuid
+import functools
+import itertools
+import collections.abc
+import secrets
+import concurrent.futures
+
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta, timezone
 from urllib.parse import urljoin, urlencode, parse_qs
 from functools import singledispatch
@@ -72,8 +84,10 @@ def argspec_for_kind(kind):
 
     return "json"
 
-def rpc(raw_args=None, command_line=None):
+def rpc(raw_args=None, command_line=None, deadline=None):
+    """ deadline is in seconds, calls that take longer carry on as a Future, see App.deadline """
     def _decorate(fn):
+        fn.deadline = deadline
         if raw_args:
             fn.__trpc__ = call_raw_function
             fn.arguments = None
@@ -124,15 +138,150 @@ class Redirect:
         self.target = target
 
 class Future:
-    def __init__(self, target, args):
+    def __init__(self, target, args, wait_seconds=None):
         self.target = target
         self.args = args
+        self.wait_seconds = wait_seconds # how long the client should wait before calling target
+        self.fn = None
+
+    @classmethod
+    def submit(cls, fn, *args, **kwargs):
+        """ run fn(*args, **kwargs) on the app's JobTable, the client waits for the result """
+        future = cls(None, None)
+        future.fn = functools.partial(fn, *args, **kwargs)
+        return future
+
+class JobTable:
+    """
+        jobs started by Future.submit, by id. the executor is a thread pool
+        by default, a process pool works too if the functions can be pickled.
+
+        finished jobs are kept for keep_seconds, so a client can collect the
+        result. jobs live in the process that started them, so under
+        --workers=N, a poll can land on a worker that doesn't know the job
+    """
+    def __init__(self, executor=None, keep_seconds=300, max_workers=None):
+        self.executor = executor # created on first use
+        self.max_workers = max_workers # for that executor, see wsgi.ThreadPoolHTTPServer.set_app
+        self.keep_seconds = keep_seconds
+        self.lock = threading.Lock()
+        self.jobs = {} # id -> concurrent.futures.Future
+        self.finished = {} # id -> time.monotonic() when done
+
+    def submit(self, fn):
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(self.max_workers, thread_name_prefix='trpc-job')
+        return self.add(self.executor.submit(fn))
+
+    def done(self, job_id):
+        with self.lock:
+            self.finished[job_id] = time.monotonic()
+
+    def expire(self):
+        cutoff = time.monotonic() - self.keep_seconds
+        for job_id, when in list(self.finished.items()):
+            if when < cutoff:
+                self.finished.pop(job_id)
+                self.jobs.pop(job_id, None)
+
+    def add(self, future):
+        """ track a future that was started elsewhere, i.e. a task on the event loop """
+        job_id = uuid.uuid4().hex
+        with self.lock:
+            self.expire()
+            self.jobs[job_id] = future
+        future.add_done_callback(lambda f: self.done(job_id))
+        return job_id
+
+    def discard(self, job_id):
+        with self.lock:
+            self.jobs.pop(job_id, None)
+            self.finished.pop(job_id, None)
+
+    def wait(self, job_id, timeout):
+        """ returns (done, result), raises KeyError for unknown jobs, or the job's exception """
+        with self.lock:
+            future = self.jobs[job_id]
+        try:
+            return True, future.result(timeout)
+        except concurrent.futures.TimeoutError:
+            return False, None
 
 class Cursor:
-    def __init__(self, values, target, args):
+    """
+        a page of values, and the method to call for the next page. with an
+        iterator or generator for values and no target, the app slices it
+        into pages of page_size, keeping it in the App.cursors between pages
+    """
+    def __init__(self, values, target, args, page_size=None):
         self.values = values
         self.target = target
         self.args = args
+        self.page_size = page_size
+
+class CursorStore:
+    """
+        live iterators from Cursors, by an opaque token. at most max_cursors
+        are kept, the least recently used are evicted first, and ones unused
+        for ttl seconds are dropped. stats counts what happened to them
+    """
+    def __init__(self, max_cursors=1000, ttl=300):
+        self.max_cursors = max_cursors
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.cursors = collections.OrderedDict() # token -> (iterator, page size, ahead, last used), oldest first
+        self.stats = collections.Counter() # stored, resumed, finished, missing, expired, evicted
+
+    def put(self, iterator, page_size, ahead=(), token=None):
+        """ ahead is what was read from the iterator past the last page """
+        token = token or secrets.token_urlsafe(16)
+        with self.lock:
+            self.cursors[token] = (iterator, page_size, ahead, time.monotonic())
+            self.cursors.move_to_end(token)
+            self.stats['stored'] += 1
+            dropped = self.expire()
+            while len(self.cursors) > self.max_cursors:
+                _, (old, _, _, _) = self.cursors.popitem(last=False)
+                self.stats['evicted'] += 1
+                dropped.append(old)
+        self.close(dropped)
+        return token
+
+    def take(self, token):
+        """ removes and returns (iterator, page_size, ahead), raises KeyError if it's gone """
+        with self.lock:
+            dropped = self.expire()
+            entry = self.cursors.pop(token, None)
+            self.stats['resumed' if entry else 'missing'] += 1
+        self.close(dropped)
+        if entry is None:
+            raise KeyError(token)
+        return entry[:3]
+
+    def finish(self):
+        with self.lock:
+            self.stats['finished'] += 1
+
+    def expire(self):
+        cutoff = time.monotonic() - self.ttl
+        dropped = []
+        while self.cursors:
+            token, (iterator, _, _, last_used) = next(iter(self.cursors.items()))
+            if last_used >= cutoff:
+                break
+            self.cursors.popitem(last=False)
+            self.stats['expired'] += 1
+            dropped.append(iterator)
+        return dropped
+
+    def close(self, iterators):
+        for iterator in iterators:
+            close = getattr(iterator, 'close', None)
+            if close is not None:
+                close()
+
+    def __len__(self):
+        return len(self.cursors)
 
 class Endpoint:
     def __init__(self, app, prefix, name, obj):
@@ -144,6 +293,14 @@ class Endpoint:
     def endpoint_for(self):
         return ()
 
+    def compile_routes(self):
+        """ (path, index, handler) for every static route, see App.routes """
+        return ()
+
+    def compile_urls(self):
+        """ (obj, url) for every object with a fixed url, see App.urls """
+        return ()
+
 class ServiceEndpoint(Endpoint):
     def __init__(self, app, prefix, name, service):
         self.prefix = prefix
@@ -165,6 +322,37 @@ class ServiceEndpoint(Endpoint):
     def endpoint_for(self):
         return (self.service,)
 
+    def methods(self):
+        for key, m in self.service.__dict__.items():
+            if not key.startswith('_') and hasattr(m, '__trpc__') and isinstance(m, types.FunctionType):
+                yield key, m
+
+    def compile_routes(self):
+        index = len(self.prefix)
+        path = tuple(self.prefix)
+
+        def describe(route, request):
+            return self.describe_trpc_endpoint(embed=True)
+        yield path + ('',), index, describe
+
+        for key, m in self.methods():
+            yield path + (key,), index, self.make_handler(key, m)
+
+    def make_handler(self, name, fn):
+        service, app, handler = self.service, self.app, fn.__trpc__
+        def handle(route, request):
+            if request.method == 'POST':
+                return handler(getattr(service(app, route, request), name), route, request)
+        handle.is_coroutine = inspect.iscoroutinefunction(fn)
+        handle.deadline = getattr(fn, 'deadline', None)
+        return handle
+
+    def compile_urls(self):
+        url = "/{}/".format("/".join(self.prefix))
+        yield self.service, url
+        for key, m in self.methods():
+            yield m, url+key
+
     def handle_trpc_request(self, route, request):
         second = route.head
         if not second:
@@ -182,9 +370,8 @@ class ServiceEndpoint(Endpoint):
 
     def describe_trpc_endpoint(self, embed):
         methods = {}
-        for key, m in self.service.__dict__.items():
-            if not key.startswith('_') and hasattr(m, '__trpc__') and isinstance(m, types.FunctionType):
-                methods[key] = wire.Procedure(m.arguments, m.command_line).embed()
+        for key, m in self.methods():
+            methods[key] = wire.Procedure(m.arguments, m.command_line).embed()
 
         return wire.Service(name=self.name, methods=methods)
 
@@ -223,6 +410,18 @@ class NamespaceEndpoint(Endpoint):
             route.append(obj.__name__)
             return route
 
+    def compile_routes(self):
+        def describe(route, request):
+            return self.describe_trpc_endpoint(embed=True)
+        yield tuple(self.prefix) + ('',), len(self.prefix), describe
+
+        for value in self.namespace.values():
+            yield from value.compile_routes()
+
+    def compile_urls(self):
+        for value in self.namespace.values():
+            yield from value.compile_urls()
+
     def handle_trpc_request(self, route, request):
         first = route.head
 
@@ -267,6 +466,7 @@ class Namespace:
 class FunctionEndpoint(Endpoint):
     def __init__(self, app, prefix, name, fn):
         self.app = app
+        self.prefix = prefix
         self.name = name
         self.fn = fn
 
@@ -277,14 +477,18 @@ class FunctionEndpoint(Endpoint):
         return (self.fn,)
 
     def route_for(self, obj):
-        route = list(self.prefix)
-        if obj == self.service or isinstance(obj, self.service):
-            return route
+        if obj == self.fn:
+            return list(self.prefix)
 
-        route.append(obj.__name__)
-        obj = obj.__self__
-        if obj == self.service or isinstance(obj, self.service):
-            return route
+    def compile_routes(self):
+        def handle(route, request):
+            return self.handle_trpc_request(route, request)
+        handle.is_coroutine = inspect.iscoroutinefunction(self.fn)
+        handle.deadline = getattr(self.fn, 'deadline', None)
+        yield tuple(self.prefix), len(self.prefix), handle
+
+    def compile_urls(self):
+        yield self.fn, "/{}".format("/".join(self.prefix))
 
     def handle_trpc_request(self, route, request):
         if request.method == 'GET':
@@ -301,13 +505,15 @@ class FunctionEndpoint(Endpoint):
         return wire.Procedure(self.fn.arguments, self.fn.command_line)
 
 class ModelEndpoint(Endpoint):
+    supports_columns = False # get_where takes columns=True, and returns rows
+
     def __init__(self, app, prefix, name,  model):
         self.prefix = prefix
         self.app = app
         self.name = name
         self.model = model
 
-    def route_for(self):
+    def route_for(self, obj):
         route = list(self.prefix)
         if obj == self.model:
             route.append("")
@@ -316,12 +522,21 @@ class ModelEndpoint(Endpoint):
     def endpoint_for(self):
         return (self.model,)
 
+    def compile_routes(self):
+        # id/<key>, set/<key>, etc are dynamic and are left to handle_trpc_request
+        path, index = tuple(self.prefix), len(self.prefix)
+        for method in ('', 'create', 'create_many', 'delete_many', 'list'):
+            yield path + (method,), index, self.handle_trpc_request
+
+    def compile_urls(self):
+        yield self.model, "/{}/".format("/".join(self.prefix))
+
     def handle_trpc_request(self, route, request):
         method = route.head
 
         if not method:
-            if request.path[-1] != '/':
-                raise HTTPResponse('303 put a / on the end', [('Location', route.prefix+'/')], [])
+            if request.url[-1] != '/':
+                raise wire.HTTPResponse('303 put a / on the end', [('Location', route.prefix+'/')], [])
             return self.describe_trpc_endpoint()
 
         route = route.advance()
@@ -342,6 +557,12 @@ class ModelEndpoint(Endpoint):
         elif method == 'create':
             data = request.unwrap_arguments()
             return self.create_entry(data)
+        elif method == 'create_many':
+            data = request.unwrap_arguments() or {}
+            return self.create_many(data.get('items') or [])
+        elif method == 'delete_many':
+            data = request.unwrap_arguments() or {}
+            return self.delete_many(data.get('keys') or [])
         elif method == 'set':
             if key:
                 data = request.unwrap_arguments()
@@ -352,12 +573,16 @@ class ModelEndpoint(Endpoint):
                 return self.update_entry(key, data)
         elif method == 'list':
             selector = request.unwrap_param('selector')
+            if request.unwrap_param('explain'):
+                return self.explain_where(selector)
             state = request.unwrap_param('state')
             limit = request.unwrap_param('limit')
+            if self.supports_columns and request.unwrap_param('columns'):
+                return self.get_where(selector, state, limit, columns=True)
             return self.get_where(selector, state, limit)
         elif method == 'delete':
             if key:
-                return self.delete(key)
+                return self.delete_entry(key)
             else:
                 selector = request.unwrap_param('where')
                 return self.delete_where(selector)
@@ -377,18 +602,24 @@ class ModelEndpoint(Endpoint):
         pass
     def create_entry(self, data): 
         pass
+    def create_many(self, items): 
+        pass
     def update_entry(self, key, data): 
         pass
     def set_entry(self, key, data): 
         pass
     def delete_entry(self, key): 
         pass
+    def delete_many(self, keys): 
+        pass
     def watch_entry(self, key): 
         pass
     def call_entry(self, key, method, args): 
         pass
     def get_list(self, selector, cursor=None): 
         pass
+    def explain_where(self, selector):
+        pass
     def delete_list(self, selector): 
         pass
     def set_list(self, selector, value): 
@@ -399,10 +630,54 @@ class ModelEndpoint(Endpoint):
         pass
 
 class App:
+    JOB_URL = "/_jobs/wait"
+    CURSOR_URL = "/_cursors/next"
+
     def __init__(self, name, root):
         self.name = name
         self.endpoints = {}
         self.root = self.make_endpoint((), name, root)
+        self.executor = None # for sync handlers under asgi
+        self.loop = None # for async handlers called outside asgi, see run_coroutine
+        self.loop_pid = None
+        self.loop_lock = threading.Lock()
+        self.batch_executor = ThreadPoolExecutor(thread_name_prefix='trpc-batch') # for parallel batches, threads start on first use
+        self.compress_min_size = wire.COMPRESS_MIN_SIZE
+        self.max_decompressed_size = 64 * 1024 * 1024 # for compressed request bodies
+        self.jobs = JobTable()
+        self.job_poll_seconds = 1 # how long a poll waits for a job, main() raises it for --threads
+        self.processes = 1 # set by wsgi.PreforkServer, jobs and cursors only live in one process
+        self.deadline = None # seconds, for @rpc methods without their own deadline
+        self.cursors = CursorStore()
+        self.cursor_page_size = 100 # for Cursors without a page_size
+        self.max_page_size = 1000 # largest page a client can ask for, from a cursor or a model
+        self.compile()
+
+    def compile(self):
+        """
+            build the dispatch table (path tuple -> (index, handler)) and the
+            reverse table (obj -> url) used by handle_request and url_for.
+
+            anything not in the tables falls back to walking the endpoints.
+            call it again after changing endpoints, to also drop the cached schema
+        """
+        routes = {}
+        for path, index, handler in self.root.compile_routes():
+            routes[path] = (index, handler)
+        routes[tuple(self.JOB_URL.strip('/').split('/'))] = (2, self.handle_job)
+        routes[tuple(self.CURSOR_URL.strip('/').split('/'))] = (2, self.handle_cursor)
+
+        urls, seen = {}, set()
+        for obj, url in self.root.compile_urls():
+            if obj in seen:
+                urls.pop(obj, None) # shared between endpoints, so ambiguous
+                continue
+            seen.add(obj)
+            urls[obj] = url
+
+        self.routes = routes
+        self.urls = urls
+        self.cached_schema = {}
 
     def make_endpoint(self, prefix, name, obj):
         if isinstance(name, type) and issubclass(obj, Endpoint):
@@ -455,37 +730,327 @@ class App:
         if endpoint is not None:
             return endpoint.route_for(obj) 
 
+    def url_for(self, obj):
+        url = self.urls.get(getattr(obj, '__func__', obj))
+        if url is None:
+            url = "/{}".format("/".join(self.route_for(obj)))
+        return url
+
     def schema(self):
         return self.root.describe_trpc_endpoint(embed=True)
 
+    def schema_response(self, accept, if_none_match, accept_encoding=None):
+        """
+            the encoded, and maybe compressed, schema is kept for each content
+            type and encoding, each with its own etag
+        """
+        codec = wire.negotiate(accept)
+        encoding = wire.negotiate_encoding(accept_encoding)
+        key = (codec.content_type, encoding.name if encoding else None)
+        cached = self.cached_schema.get(key)
+        if cached is None:
+            data = codec.dumps(self.schema().embed())
+            etag, content_encoding = hashlib.sha1(data).hexdigest(), None
+            if encoding is not None and len(data) >= self.compress_min_size:
+                etag, content_encoding = "{}-{}".format(etag, encoding.name), encoding.name
+                data = b''.join(encoding.compress_iter([data]))
+            cached = self.cached_schema[key] = ('"{}"'.format(etag), codec.content_type, content_encoding, data)
+
+        etag, content_type, content_encoding, data = cached
+        headers = [("etag", etag), ("cache-control", "no-cache"), ("vary", "accept, accept-encoding")]
+        if if_none_match:
+            tags = [t.strip() for t in if_none_match.split(',')]
+            if etag in tags or '*' in tags:
+                return wire.HTTPResponse("304 Not Modified", headers, [])
+
+        headers.append(("content-type", content_type))
+        if content_encoding:
+            headers.append(("content-encoding", content_encoding))
+        return wire.HTTPResponse("200 Adequate", headers, [data])
+
+    def dispatch(self, request):
+        path = request.url.lstrip('/').split('/')
+        compiled = self.routes.get(tuple(path))
+
+        if compiled is not None:
+            index, handler = compiled
+            return handler(Route(request, path, index), request)
+        else:
+            return self.root.handle_trpc_request(Route(request, path, 0), request)
+
+    def single_process(self, what):
+        """ jobs and cursors are kept in memory, so the next request must come back to this process """
+        if self.processes > 1:
+            message = "{} keeps state in one process, and this server runs {} workers".format(what, self.processes)
+            raise wire.HTTPResponse('501 {} needs a single process'.format(what), [], [message.encode('utf-8')])
+
+    def handle_job(self, route, request):
+        """ long polls a job from Future.submit, for up to job_poll_seconds """
+        if request.method != 'POST':
+            return
+        job_id = (request.unwrap_arguments() or {}).get('id')
+        try:
+            done, result = self.jobs.wait(job_id, self.job_poll_seconds)
+        except KeyError:
+            raise wire.HTTPResponse('404 no such job', [], [b'unknown or expired job'])
+        if not done:
+            return wire.FutureResult(self.JOB_URL, {'id': job_id}, 0)
+        return result
+
+    def handle_cursor(self, route, request):
+        """ the next page of a Cursor over an iterator, the client's limit is the page size """
+        if request.method != 'POST':
+            return
+        token = (request.unwrap_arguments() or {}).get('token')
+        limit = request.unwrap_param('limit')
+        if limit is not None:
+            try:
+                limit = max(1, min(int(limit), self.max_page_size))
+            except (TypeError, ValueError):
+                raise wire.HTTPResponse('400 bad limit', [], [repr(limit).encode('utf-8')])
+        try:
+            iterator, page_size, ahead = self.cursors.take(token)
+        except KeyError:
+            raise wire.HTTPResponse('404 cursor expired', [], [b'unknown or expired cursor'])
+        if limit is not None:
+            page_size = limit
+        return self.cursor_page(iterator, page_size, ahead, token)
+
+    def cursor_page(self, iterator, page_size, ahead=(), token=None):
+        """ reads one past the page, so the last page never needs a token """
+        values = list(ahead)
+        values.extend(itertools.islice(iterator, page_size + 1 - len(values)))
+        if len(values) <= page_size:
+            self.cursors.finish()
+            return wire.ResultSet(values, None, None)
+        ahead = values[page_size:]
+        del values[page_size:]
+        token = self.cursors.put(iterator, page_size, ahead, token)
+        return wire.ResultSet(values, self.CURSOR_URL, {'token': token})
+
+    def handle_batch(self, request):
+        batch = wire.decode_bytes(request.data, request.content_type)
+        if not isinstance(batch, wire.Batch):
+            raise wire.HTTPResponse('400 expecting a Batch', [], [b'no'])
+
+        def call(entry):
+            path = entry.get('path') or ''
+            params = {k:json.dumps(v) for k,v in (entry.get('params') or {}).items()}
+            args = entry.get('args')
+            sub = wire.HTTPRequest('POST', path, params, request.headers, None, None, None,
+                arguments=wire.Arguments(args) if args is not None else None)
+            try:
+                if not path.lstrip('/'):
+                    raise wire.HTTPResponse('400 no nested batches', [], [])
+                return self.handle_request(sub).embed()
+            except wire.HTTPResponse as r:
+                return wire.Error(r.status, b''.join(r.body).decode('utf-8', 'replace')).embed()
+            except Exception as e:
+                self.report_error()
+                return wire.Error("500 bad", repr(e)).embed()
+
+        calls = batch.calls or []
+        if batch.parallel and len(calls) > 1:
+            results = list(self.batch_executor.map(call, calls))
+        else:
+            results = [call(entry) for entry in calls]
+        return wire.BatchResult(results)
+
     def handle_request(self, request):
-        route = Route(request, request.url.lstrip('/').split('/'), 0)
-        
-        out = self.root.handle_trpc_request(route, request)
+        if request.method == 'POST' and not request.url.lstrip('/'):
+            return self.handle_batch(request)
+
+        deadline = self.deadline_for(request)
+        if deadline is not None:
+            return self.make_response(self.dispatch_with_deadline(request, deadline))
+
+        out = self.dispatch(request)
+        if inspect.isawaitable(out):
+            out = self.run_coroutine(out) # async def handler, outside of asgi
+        return self.make_response(out)
+
+    def deadline_for(self, request):
+        compiled = self.routes.get(tuple(request.url.lstrip('/').split('/')))
+        if compiled is None or not hasattr(compiled[1], 'deadline'):
+            return None
+        deadline = compiled[1].deadline
+        return self.deadline if deadline is None else deadline
+
+    def dispatch_job(self, request):
+        out = self.dispatch(request)
+        if inspect.isawaitable(out):
+            out = self.run_coroutine(out)
+        return out
+
+    def event_loop(self):
+        """ the asgi server's loop, or one on a background thread, started on first use """
+        with self.loop_lock:
+            if self.loop is None or self.loop.is_closed() or self.loop_pid != os.getpid():
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name='trpc-loop', daemon=True).start()
+                self.loop, self.loop_pid = loop, os.getpid()
+            return self.loop
+
+    def run_coroutine(self, aw):
+        """
+            await an async handler from a thread, on one long lived loop, so
+            handlers can keep locks, clients, or pools between calls
+        """
+        loop = self.event_loop()
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if running is loop:
+            if inspect.iscoroutine(aw):
+                aw.close()
+            raise wire.HTTPResponse('500 bad', [], [b'an async handler was called from a blocking call on its own event loop'])
+        async def wait():
+            return await aw
+        return asyncio.run_coroutine_threadsafe(wait(), loop).result()
+
+    def dispatch_with_deadline(self, request, deadline):
+        """
+            runs the handler as a job, returning its result if it is done in
+            time, or a FutureResult. under prefork the poll could land on
+            another worker, so there the deadline is ignored
+        """
+        job_id = self.jobs.submit(functools.partial(self.dispatch_job, request))
+        done = True
+        try:
+            done, result = self.jobs.wait(job_id, deadline if self.processes == 1 else None)
+        finally:
+            if done: # or raised
+                self.jobs.discard(job_id)
+        if not done:
+            return wire.FutureResult(self.JOB_URL, {'id': job_id}, 0)
+        return result
+
+    async def handle_request_async(self, request):
+        """ awaits async handlers on the loop, runs the others on self.executor """
+        loop = asyncio.get_running_loop()
+        if request.method == 'POST' and not request.url.lstrip('/'):
+            return await loop.run_in_executor(self.executor, self.handle_batch, request)
+
+        path = request.url.lstrip('/').split('/')
+        compiled = self.routes.get(tuple(path))
+
+        deadline = self.deadline_for(request)
+
+        if compiled is not None and getattr(compiled[1], 'is_coroutine', False):
+            index, handler = compiled
+            out = handler(Route(request, path, index), request)
+            if deadline is not None:
+                out = await self.await_with_deadline(out, deadline)
+        elif deadline is not None:
+            out = await loop.run_in_executor(self.executor, self.dispatch_with_deadline, request, deadline)
+        else:
+            out = await loop.run_in_executor(self.executor, self.dispatch, request)
+
+        if inspect.isawaitable(out):
+            out = await out
+        return self.make_response(out)
+
+    async def await_with_deadline(self, aw, deadline):
+        """ like dispatch_with_deadline, but the job is a task on this event loop """
+        task = asyncio.ensure_future(aw)
+        done, _ = await asyncio.wait([task], timeout=deadline)
+        if done:
+            return task.result()
+
+        future = concurrent.futures.Future()
+        def finished(task):
+            if task.cancelled():
+                future.cancel()
+            elif task.exception() is not None:
+                future.set_exception(task.exception())
+            else:
+                future.set_result(task.result())
+        task.add_done_callback(finished)
+        job_id = self.jobs.add(future)
+        return wire.FutureResult(self.JOB_URL, {'id': job_id}, 0)
+
+    def make_response(self, out):
         if isinstance(out, Redirect):
-            route = self.route_for(out.target)
-            url = "/{}".format("/".join(route))
+            url = self.url_for(out.target)
             status = "303 TB"
             headers = [("Location", url)]
-            return wire.HTTPResponse(status, headers, [])
+            raise wire.HTTPResponse(status, headers, [])
 
         if isinstance(out, Future):
-            route = self.route_for(out.target)
-            url = "/{}".format("/".join(route))
-            out = wire.FutureResult(url, out.args)
+            if out.fn is not None:
+                self.single_process('Future.submit')
+                job_id = self.jobs.submit(out.fn)
+                out = wire.FutureResult(self.JOB_URL, {'id': job_id}, 0)
+            else:
+                url = self.url_for(out.target)
+                out = wire.FutureResult(url, out.args, out.wait_seconds)
+        elif isinstance(out, Cursor) and out.target is None and isinstance(out.values, collections.abc.Iterator):
+            self.single_process('a Cursor over an iterator')
+            out = self.cursor_page(out.values, out.page_size or self.cursor_page_size)
         elif isinstance(out, Cursor):
             if out.target:
-                route = self.route_for(out.target)
-                url = "/{}".format("/".join(route))
+                url = self.url_for(out.target)
             else:
                 url = None
             out = wire.ResultSet(out.values, url, out.args)
+        elif inspect.isgenerator(out):
+            out = wire.Stream(out)
         else:
             out = wire.wrap(out)
 
         return out
 
 
+    def decode_body(self, data, content_encoding):
+        if not content_encoding or content_encoding.strip().lower() == 'identity':
+            return data
+        encoding = wire.encoding_for(content_encoding)
+        if encoding is None:
+            raise wire.HTTPResponse('415 unsupported content encoding', [], [content_encoding.encode('latin-1')])
+        if not data:
+            return data
+        try:
+            out = encoding.decompress(data, self.max_decompressed_size)
+        except Exception as e:
+            raise wire.HTTPResponse('400 bad {} body'.format(encoding.name), [], [repr(e).encode('utf-8')])
+        if out is None:
+            raise wire.HTTPResponse('413 too large', [], [b'decompressed body is over the limit'])
+        return out or None
+
+    def report_error(self):
+        """ called in the except block of every 500, including ones sent part way through a response """
+        traceback.print_exc()
+
+    @staticmethod
+    def first_chunk(content_type, body):
+        """
+            run an incremental body up to its first chunk, so errors from the
+            handler's generator still become error responses. streams report
+            their own errors as frames, and may wait a while before the first.
+        """
+        if isinstance(body, list) or wire.is_stream(content_type):
+            return body
+        body = iter(body)
+        for chunk in body:
+            return itertools.chain([chunk], body)
+        return []
+
+    def compress_response(self, response, accept_encoding):
+        """ streamed bodies are always compressed, others only over compress_min_size """
+        headers = list(response.headers)
+        headers.append(("vary", "accept-encoding"))
+        encoding = wire.negotiate_encoding(accept_encoding)
+        body = response.body
+        if encoding is None or (isinstance(body, list) and sum(len(c) for c in body) < self.compress_min_size):
+            return wire.HTTPResponse(response.status, headers, body)
+        headers.append(("content-encoding", encoding.name))
+        if isinstance(body, list):
+            body = [b''.join(encoding.compress_iter(body))]
+        else:
+            body = encoding.compress_iter(body)
+        return wire.HTTPResponse(response.status, headers, body)
+
     def __call__(self, environ, start_response):
         try:
             method = environ.get('REQUEST_METHOD', '')
@@ -504,15 +1069,22 @@ class App:
                 data = None
             headers = {name[5:].lower():value for name, value in environ.items() if name.startswith('HTTP_')}
             accept = headers.get('accept', wire.CONTENT_TYPE).split(',')
+            accept_encoding = headers.get('accept_encoding')
 
             try:
-                request = wire.HTTPRequest(method, path, parameters, headers, content_type, data, None)
-                out = self.handle_request(request)
-
-                content_type, data = out.encode(accept)
-                status = "200 Adequate"
-                headers = [("content-type", content_type)]
-                response = wire.HTTPResponse(status, headers, [data])
+                if method == 'GET' and path == '/':
+                    response = self.schema_response(accept, headers.get('if_none_match'), accept_encoding)
+                else:
+                    data = self.decode_body(data, headers.pop('content_encoding', None))
+                    request = wire.HTTPRequest(method, path, parameters, headers, content_type, data, None)
+                    out = self.handle_request(request)
+
+                    content_type, body = out.encode_iter(accept, self.report_error)
+                    body = self.first_chunk(content_type, body)
+                    status = "200 Adequate"
+                    headers = [("content-type", content_type)]
+                    response = wire.HTTPResponse(status, headers, body)
+                    response = self.compress_response(response, accept_encoding)
             except wire.HTTPResponse as r:
                 response = r
 
@@ -525,9 +1097,94 @@ class App:
             response_headers = [("content-type", "text/plain")]
 
             start_response(status, response_headers, sys.exc_info())
-            traceback.print_exc()
+            self.report_error()
             return [traceback.format_exc().encode('utf8')]
 
+    async def asgi(self, scope, receive, send):
+        """ ASGI entry point, i.e. `uvicorn module:app.asgi` """
+        loop = asyncio.get_running_loop()
+        if self.loop is not loop:
+            with self.loop_lock: # async handlers in batches and jobs run here too
+                self.loop, self.loop_pid = loop, os.getpid()
+        if scope['type'] == 'lifespan':
+            while True:
+                message = await receive()
+                if message['type'] == 'lifespan.startup':
+                    await send({'type': 'lifespan.startup.complete'})
+                elif message['type'] == 'lifespan.shutdown':
+                    await send({'type': 'lifespan.shutdown.complete'})
+                    return
+        elif scope['type'] != 'http':
+            return
+
+        try:
+            method = scope['method']
+            path = scope['path']
+            parameters = parse_qs(scope.get('query_string', b'').decode('latin-1'))
+            parameters = {k:v[0] for k,v in parameters.items()}
+            headers = {}
+            for name, value in scope['headers']:
+                name = name.decode('latin-1').lower().replace('-', '_')
+                value = value.decode('latin-1')
+                headers[name] = "{},{}".format(headers[name], value) if name in headers else value
+
+            chunks = []
+            while True:
+                message = await receive()
+                if message['type'] == 'http.disconnect':
+                    return
+                chunks.append(message.get('body', b''))
+                if not message.get('more_body'):
+                    break
+            data = b''.join(chunks) or None
+            content_type = headers.pop('content_type', '')
+            accept = headers.get('accept', wire.CONTENT_TYPE).split(',')
+            accept_encoding = headers.get('accept_encoding')
+
+            try:
+                if method == 'GET' and path == '/':
+                    response = self.schema_response(accept, headers.get('if_none_match'), accept_encoding)
+                else:
+                    data = self.decode_body(data, headers.pop('content_encoding', None))
+                    request = wire.HTTPRequest(method, path, parameters, headers, content_type, data, None)
+                    out = await self.handle_request_async(request)
+
+                    content_type, body = out.encode_iter(accept, self.report_error)
+                    loop = asyncio.get_running_loop()
+                    body = await loop.run_in_executor(self.executor, self.first_chunk, content_type, body)
+                    status = "200 Adequate"
+                    headers = [("content-type", content_type)]
+                    response = wire.HTTPResponse(status, headers, body)
+                    response = self.compress_response(response, accept_encoding)
+            except wire.HTTPResponse as r:
+                response = r
+        except (StopIteration, GeneratorExit, SystemExit, KeyboardInterrupt, asyncio.CancelledError):
+            raise
+        except Exception as e:
+            self.report_error()
+            response = wire.HTTPResponse("500 bad", [("content-type", "text/plain")], [traceback.format_exc().encode('utf8')])
+
+        await send({
+            'type': 'http.response.start',
+            'status': int(response.status.split(' ', 1)[0]),
+            'headers': [(k.encode('latin-1'), v.encode('latin-1')) for k, v in response.headers],
+        })
+        if isinstance(response.body, list):
+            for chunk in response.body:
+                if chunk:
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        else:
+            # streams may block between chunks, so keep them off the event loop
+            loop = asyncio.get_running_loop()
+            body = iter(response.body)
+            while True:
+                chunk = await loop.run_in_executor(self.executor, next, body, None)
+                if chunk is None:
+                    break
+                if chunk:
+                    await send({'type': 'http.response.body', 'body': chunk, 'more_body': True})
+        await send({'type': 'http.response.body', 'body': b''})
+
     def automain(self, name, port=1729):
         if name != '__main__':
             return
@@ -535,12 +1192,20 @@ class App:
 
     def main(self,port=1729):
         serve = False
+        threads = None
+        workers = None
         if 'COMP_LINE' not in os.environ and 'COMP_POINT' not in os.environ:
             argv = list()
             for arg in sys.argv[1:]:
                 if arg.startswith('--port='):
                     port = int(arg[7:])
                     serve = True
+                elif arg.startswith('--threads='):
+                    threads = int(arg[10:])
+                    serve = True
+                elif arg.startswith('--workers='):
+                    workers = int(arg[10:])
+                    serve = True
                 elif arg == "--serve":
                     serve = True
                 else:
@@ -568,7 +1233,15 @@ class App:
             return cli.CLI(session).main(argv, environ)
 
 
-        s = wsgi.WSGIServer(self, port=port, request_handler=wsgi.WSGIRequestHandler)
+        if workers:
+            request_handler = wsgi.KeepAliveRequestHandler if threads else wsgi.WSGIRequestHandler
+            s = wsgi.PreforkServer(self, port=port, workers=workers, threads=threads, request_handler=request_handler)
+        elif threads:
+            # a long poll only ties up one of the pool's threads, rather than the whole server
+            self.job_poll_seconds = max(self.job_poll_seconds, 20)
+            s = wsgi.ThreadPoolWSGIServer(self, port=port, threads=threads, request_handler=wsgi.KeepAliveRequestHandler)
+        else:
+            s = wsgi.WSGIServer(self, port=port, request_handler=wsgi.WSGIRequestHandler)
 
         try:
             s.start()
@@ -586,8 +1259,7 @@ class App:
                 print(s.url)
                 print('Press ^C to exit')
 
-                while True:
-                    pass
+                s.wait()
         except KeyboardInterrupt:
             pass
         finally:
@@ -603,6 +1275,7 @@ class AppSession(client.Session):
             url = urljoin(base_url, request.path)
             return url, out
         else:
-            request = request.make_http(base_url)
+            if isinstance(request, wire.Request):
+                request = request.make_http(base_url)
             out = self.app.handle_request(request)
             return request.url, out
@@ -16,25 +16,464 @@ other top level fields include
 
 """
 
+import abc
 import json
-from urllib.parse import urljoin, urlencode
+import codecs
+import re
+import io
+import traceback
+import zlib
+from urllib.parse import urljoin, urlencode, urlsplit
+
+from . import errors
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 CONTENT_TYPE = "application/trpc+json"
+CHUNK_SIZE = 65536
+COMPRESS_MIN_SIZE = 1024 # smaller bodies are sent as is
+STREAM_CONTENT_TYPE = "application/trpc+ndjson"
+
+def is_stream(content_type):
+    return bool(content_type) and content_type.split(';', 1)[0].strip().lower() == STREAM_CONTENT_TYPE
+
+def url_origin(url):
+    """ scheme://host:port, what clients negotiate codecs and encodings per """
+    parts = urlsplit(url or '')
+    return '{}://{}'.format(parts.scheme, parts.netloc.rsplit('@', 1)[-1].lower())
+
+def media_params(content_type):
+    """ the parameters of a Content-Type, i.e. {'lines': '1'} """
+    params = {}
+    for param in (content_type or '').split(';')[1:]:
+        name, _, value = param.partition('=')
+        params[name.strip().lower()] = value.strip().strip('"')
+    return params
+
+class Codec(abc.ABC):
+    content_type = None
+    iter_content_type = None # for dumps_iter output, if it differs
+
+    @abc.abstractmethod
+    def dumps(self, obj):
+        pass
+
+    def dumps_iter(self, obj, field, items, on_error=None):
+        """
+            yield obj with obj[field] = items as chunks, items may be a generator.
+            on_error is called in the except block when an error can't be
+            raised, as it happened after the first chunk
+        """
+        obj[field] = list(items)
+        yield self.dumps(obj)
+
+    @abc.abstractmethod
+    def loads(self, data):
+        pass
+
+    def load(self, fh, content_type=None):
+        return self.loads(fh.read())
+
+class JSONReader:
+    """
+        reads a json object from a file, one top level value at a time, and
+        top level lists a few items at a time, so the whole body is never
+        held in memory as a string.
+
+        JSONCodec.dumps_iter puts each list item on its own line, and says
+        so with a lines=1 content type parameter. json never has a raw
+        newline inside a value, so with lines set, those lists are decoded a
+        buffer of lines at a time. other lists are decoded item by item.
+    """
+    decoder = json.JSONDecoder()
+    whitespace = re.compile(r'[ \t\n\r]*')
+    numeric = re.compile(r'[0-9+\-.eE]*')
+
+    def __init__(self, fh, size=CHUNK_SIZE, lines=False):
+        self.fh = fh
+        self.size = size
+        self.lines_mode = lines
+        self.utf8 = codecs.getincrementaldecoder('utf-8')()
+        self.buf = ''
+        self.pos = 0
+        self.eof = False
+
+    def fill(self, size):
+        data = self.fh.read(size)
+        if not data:
+            self.eof = True
+        self.buf = self.buf[self.pos:] + self.utf8.decode(data or b'', final=self.eof)
+        self.pos = 0
+
+    def peek(self):
+        while True:
+            buf = self.buf
+            pos = self.pos = self.whitespace.match(buf, self.pos).end()
+            if pos < len(buf) or self.eof:
+                return buf[pos:pos+1]
+            self.fill(self.size)
+
+    def expect(self, chars):
+        c = self.peek()
+        if not c or c not in chars:
+            raise ValueError("expecting {!r}, got {!r}".format(chars, c))
+        self.pos += 1
+        return c
+
+    def value(self):
+        self.peek()
+        size = self.size
+        while True:
+            try:
+                obj, end = self.decoder.raw_decode(self.buf, self.pos)
+                if self.eof or self.numeric.match(self.buf, end).end() < len(self.buf):
+                    self.pos = end
+                    return obj
+                # a number (or nothing) runs up to the end, it might continue
+            except json.JSONDecodeError:
+                if self.eof:
+                    raise
+            self.fill(size)
+            size *= 2
+
+    def array(self):
+        self.expect('[')
+        items = []
+        if self.pos == len(self.buf) and not self.eof:
+            self.fill(self.size)
+        if self.lines_mode and self.buf.startswith('\n', self.pos):
+            return self.lines(items)
+        if self.peek() == ']':
+            self.pos += 1
+            return items
+        while True:
+            items.append(self.value())
+            if self.expect(',]') == ']':
+                return items
+
+    def lines(self, items):
+        self.pos += 1
+        while True:
+            buf, pos = self.buf, self.pos
+            if buf.startswith(']', pos):
+                self.pos += 1
+                return items
+            end = buf.rfind('\n', pos)
+            if end > pos:
+                items.extend(json.loads('[{}]'.format(buf[pos:end].rstrip(','))))
+                self.pos = end + 1
+            elif self.eof:
+                raise ValueError("unterminated list")
+            else:
+                self.fill(self.size)
+
+    def read(self):
+        if self.peek() != '{':
+            return self.value()
+        self.pos += 1
+        obj = {}
+        if self.peek() == '}':
+            self.pos += 1
+            return obj
+        while True:
+            key = self.value()
+            self.expect(':')
+            obj[key] = self.array() if self.peek() == '[' else self.value()
+            if self.expect(',}') == '}':
+                return obj
+
+class JSONCodec(Codec):
+    content_type = CONTENT_TYPE
+    iter_content_type = CONTENT_TYPE + "; lines=1"
+
+    def dumps(self, obj):
+        return json.dumps(obj).encode('utf-8')
+
+    def dumps_iter(self, obj, field, items, on_error=None):
+        """
+            errors before the first chunk are raised, later ones close the
+            list and add an "error" field with an Error, see decode_file
+        """
+        head = json.dumps(obj)
+        parts = [head[:-1], ', ' if obj else '', json.dumps(field), ': [']
+        size, first, sent = 0, True, False
+        try:
+            for item in items: # one per line, see JSONReader
+                parts.append('\n' if first else ',\n')
+                first = False
+                item = json.dumps(item)
+                parts.append(item)
+                size += len(item)
+                if size >= CHUNK_SIZE:
+                    yield ''.join(parts).encode('utf-8')
+                    parts, size, sent = [], 0, True
+        except Exception as e:
+            if not sent:
+                raise
+            (on_error or traceback.print_exc)()
+            error = json.dumps(Error("500 bad", repr(e)).embed())
+            parts.append('\n], "error": {}}}'.format(error))
+            yield ''.join(parts).encode('utf-8')
+            return
+        parts.append(']}' if first else '\n]}')
+        yield ''.join(parts).encode('utf-8')
+
+    def loads(self, data):
+        return json.loads(data.decode('utf-8'))
+
+    def load(self, fh, content_type=None):
+        lines = media_params(content_type).get('lines') == '1'
+        return JSONReader(fh, lines=lines).read()
+
+class MsgpackCodec(Codec):
+    content_type = "application/trpc+msgpack"
+
+    def dumps(self, obj):
+        return msgpack.packb(obj, use_bin_type=True)
+
+    def dumps_iter(self, obj, field, items, on_error=None):
+        packer = msgpack.Packer(use_bin_type=True)
+        if not isinstance(items, (list, tuple)):
+            items = list(items) # msgpack needs the length up front
+        parts = [packer.pack_map_header(len(obj) + 1)]
+        for key, value in obj.items():
+            parts.append(packer.pack(key))
+            parts.append(packer.pack(value))
+        parts.append(packer.pack(field))
+        parts.append(packer.pack_array_header(len(items)))
+        size = 0
+        for item in items:
+            item = packer.pack(item)
+            parts.append(item)
+            size += len(item)
+            if size >= CHUNK_SIZE:
+                yield b''.join(parts)
+                parts, size = [], 0
+        yield b''.join(parts)
+
+    def loads(self, data):
+        return msgpack.unpackb(data, raw=False, strict_map_key=False)
+
+    def load(self, fh, content_type=None):
+        unpacker = msgpack.Unpacker(fh, raw=False, strict_map_key=False, read_size=CHUNK_SIZE)
+        return unpacker.unpack()
+
+CODECS = {} # content type -> codec, in order of preference
+
+def register_codec(codec, preferred=False):
+    if preferred:
+        codecs = dict(CODECS)
+        CODECS.clear()
+        CODECS[codec.content_type] = codec
+        CODECS.update(codecs)
+    else:
+        CODECS[codec.content_type] = codec
+
+register_codec(JSONCodec())
+if msgpack is not None:
+    register_codec(MsgpackCodec(), preferred=True)
+
+def accept_header():
+    return ", ".join(list(CODECS) + [STREAM_CONTENT_TYPE])
+
+def accepts(accept, content_type):
+    """ is content_type listed in an Accept header (split on ',') """
+    for item in accept or ():
+        if item.split(';', 1)[0].strip().lower() == content_type:
+            return True
+    return False
+
+def codec_for(content_type):
+    if content_type:
+        return CODECS.get(content_type.split(';', 1)[0].strip().lower())
+
+def ranked(accept):
+    """ the items of an Accept style header (split on ','), best first, without q=0 """
+    out = []
+    for n, item in enumerate(accept or ()):
+        name, *params = item.split(';')
+        q = 1.0
+        for p in params:
+            key, _, value = p.partition('=')
+            if key.strip() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        if q > 0:
+            out.append((-q, n, name.strip().lower()))
+    return [name for _, _, name in sorted(out)]
+
+def negotiate(accept):
+    """ pick a codec for an Accept header (split on ','), falling back to json """
+    for content_type in ranked(accept):
+        codec = codec_for(content_type)
+        if codec:
+            return codec
+    return CODECS[CONTENT_TYPE]
+
+class Encoding(abc.ABC):
+    """ a Content-Encoding, compress_iter flushes after every chunk so streams aren't held back """
+    name = None
+
+    @abc.abstractmethod
+    def compress_iter(self, chunks):
+        pass
+
+    @abc.abstractmethod
+    def decompress(self, data, max_size):
+        """ returns None if the output would be larger than max_size """
+
+    @abc.abstractmethod
+    def decompressobj(self):
+        pass
+
+class GzipEncoding(Encoding):
+    name = 'gzip'
+
+    def compress_iter(self, chunks):
+        c = zlib.compressobj(6, zlib.DEFLATED, 31)
+        for chunk in chunks:
+            out = c.compress(chunk) + c.flush(zlib.Z_SYNC_FLUSH)
+            if out:
+                yield out
+        yield c.flush()
+
+    def decompress(self, data, max_size):
+        d = self.decompressobj()
+        out = d.decompress(data, max_size + 1)
+        if len(out) > max_size:
+            return None
+        if not d.eof:
+            raise ValueError("truncated gzip body")
+        return out
+
+    def decompressobj(self):
+        return zlib.decompressobj(47) # gzip or zlib header
+
+class ZstdEncoding(Encoding):
+    name = 'zstd'
+
+    def compress_iter(self, chunks):
+        c = zstandard.ZstdCompressor().compressobj()
+        for chunk in chunks:
+            out = c.compress(chunk) + c.flush(zstandard.COMPRESSOBJ_FLUSH_BLOCK)
+            if out:
+                yield out
+        yield c.flush()
+
+    def decompress(self, data, max_size):
+        out = []
+        size = 0
+        with zstandard.ZstdDecompressor().stream_reader(data) as reader:
+            while size <= max_size:
+                chunk = reader.read(CHUNK_SIZE)
+                if not chunk:
+                    return b''.join(out)
+                out.append(chunk)
+                size += len(chunk)
+        return None
+
+    def decompressobj(self):
+        return zstandard.ZstdDecompressor().decompressobj()
+
+ENCODINGS = {} # content encoding -> Encoding, in order of preference
+
+def register_encoding(encoding, preferred=False):
+    if preferred:
+        encodings = dict(ENCODINGS)
+        ENCODINGS.clear()
+        ENCODINGS[encoding.name] = encoding
+        ENCODINGS.update(encodings)
+    else:
+        ENCODINGS[encoding.name] = encoding
+
+register_encoding(GzipEncoding())
+if zstandard is not None:
+    register_encoding(ZstdEncoding(), preferred=True)
+
+def accept_encoding_header():
+    return ", ".join(ENCODINGS)
+
+def encoding_for(content_encoding):
+    if content_encoding:
+        return ENCODINGS.get(content_encoding.strip().lower())
+
+def negotiate_encoding(accept_encoding):
+    """ pick an Encoding for an Accept-Encoding header (a string), None for identity """
+    for name in ranked((accept_encoding or '').split(',')):
+        if name == '*' and ENCODINGS:
+            return next(iter(ENCODINGS.values()))
+        encoding = encoding_for(name)
+        if encoding:
+            return encoding
+
+def decode_content(data, content_encoding):
+    """ decompress a whole response body """
+    encoding = encoding_for(content_encoding)
+    if encoding is None or not data:
+        return data
+    d = encoding.decompressobj()
+    return d.decompress(data) + d.flush()
+
+class DecodedFile(io.RawIOBase):
+    """ decompresses a response as it is read, wrap in io.BufferedReader for readline """
+    def __init__(self, fh, decompressobj):
+        self.fh = fh
+        self.decompressobj = decompressobj
+        self.pending = memoryview(b'')
+        self.eof = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self.pending:
+            if self.eof:
+                return 0
+            read1 = getattr(self.fh, 'read1', self.fh.read)
+            data = read1(CHUNK_SIZE)
+            if data:
+                self.pending = memoryview(self.decompressobj.decompress(data))
+            else:
+                self.pending = memoryview(self.decompressobj.flush())
+                self.eof = True
+        n = min(len(b), len(self.pending))
+        b[:n] = self.pending[:n]
+        self.pending = self.pending[n:]
+        return n
 
 def decode_file(obj, content_type):
     if not obj:
         return None
-    if content_type == CONTENT_TYPE:
-        return decode_object(json.load(obj))
+    if is_stream(content_type):
+        return Stream.from_file(obj)
+    codec = codec_for(content_type)
+    if codec:
+        return decode_object(codec.load(obj, content_type))
 
 def decode_bytes(obj, content_type):
     if not obj:
         return None
-    if content_type == CONTENT_TYPE:
-        return decode_object(json.loads(obj.decode('utf-8')))
+    if is_stream(content_type):
+        return Stream.from_file(io.BytesIO(obj))
+    codec = codec_for(content_type)
+    if codec:
+        return decode_object(codec.loads(obj))
 
 def decode_object(obj):
     kind = obj.get('kind')
+    if kind != 'Error' and isinstance(obj.get('error'), dict):
+        # an incremental body that failed part way, see JSONCodec.dumps_iter
+        raise RemoteError(decode_object(obj['error']))
     return Message.init_from_dict(obj)
 
 def wrap(out):
@@ -52,7 +491,7 @@ class HTTPResponse(Exception):
         self.body = body
 
 class HTTPRequest:
-    def __init__(self, method, url, params, headers, content_type, data, cached):
+    def __init__(self, method, url, params, headers, content_type, data, cached, arguments=None):
         self.method = method
         self.url = url
         self.params = params
@@ -60,8 +499,11 @@ class HTTPRequest:
         self.content_type = content_type
         self.data = data
         self.cached = cached
+        self.arguments = arguments # already decoded, i.e. inside a Batch
 
     def unwrap_arguments(self):
+        if self.arguments is not None:
+            return self.arguments.values
         data = decode_bytes(self.data, self.content_type)
         if isinstance(data, Arguments):
             return data.values
@@ -79,10 +521,11 @@ class Request:
         self.args = args
         self.cached = cached
 
-    def make_http(self, base_url):
+    def make_http(self, base_url, content_type=CONTENT_TYPE):
+        """ content_type is for the request body """
         method = "GET" if self.mode in ("get","walk", "list") else "POST"
         if self.args is not None:
-            content_type, data = Arguments(self.args).encode()
+            content_type, data = Arguments(self.args).encode([content_type])
         else:
             content_type, data = None, b""
 
@@ -97,7 +540,7 @@ class Request:
             url = url,
             data = data, 
             params = params,
-            headers = {'Accept': CONTENT_TYPE},
+            headers = {'Accept': accept_header()},
             content_type = content_type,
             cached = self.cached
         )
@@ -109,6 +552,7 @@ class Message:
     Metadata = () # metadata field names
     apiVersion = 'v0'
     enumerable = False
+    Incremental = None # a list field that's encoded one item at a time
 
     # subclass hook
     def __init_subclass__(cls):
@@ -153,7 +597,14 @@ class Message:
         return "{}: {}".format(self.kind, fields)
 
     def embed(self):
-        fields = {k:getattr(self, k) for k in self.Fields}
+        if self.Incremental:
+            items = getattr(self, self.Incremental)
+            if items is not None and not isinstance(items, (list, tuple)):
+                setattr(self, self.Incremental, list(items)) # a generator, only read once
+        return self.embed_fields(self.Fields)
+
+    def embed_fields(self, names):
+        fields = {k:getattr(self, k) for k in names}
         metadata = {k:getattr(self, k) for k in self.Metadata}
         return dict(
             kind=self.kind,
@@ -163,8 +614,17 @@ class Message:
         )
 
     def encode(self, accept=None):
-        data = json.dumps(self.embed())
-        return CONTENT_TYPE, data.encode('utf-8')
+        content_type, chunks = self.encode_iter(accept)
+        return content_type, b''.join(chunks)
+
+    def encode_iter(self, accept=None, on_error=None):
+        """ returns content_type, chunks, see Codec.dumps_iter for on_error """
+        codec = negotiate(accept)
+        items = getattr(self, self.Incremental) if self.Incremental else None
+        if items is None:
+            return codec.content_type, [codec.dumps(self.embed())]
+        obj = self.embed_fields([k for k in self.Fields if k != self.Incremental])
+        return codec.iter_content_type or codec.content_type, codec.dumps_iter(obj, self.Incremental, items, on_error)
 
     def get_routes(self):
         return ()
@@ -205,6 +665,20 @@ class FutureResult(Message):
     def make_request(self):
         return Request('call', self.url, {}, self.args, None)
 
+    def poll_delay(self, polls, max_seconds=10):
+        """
+            seconds to wait before the next request, after `polls` requests
+            have already returned a FutureResult. wait_seconds doubles
+            each time, up to max_seconds. 0 means the server long polls.
+            without wait_seconds, the first retry is immediate
+        """
+        wait_seconds = self.wait_seconds
+        if wait_seconds is None:
+            if not polls:
+                return 0
+            wait_seconds, polls = 0.05, polls - 1
+        return min(wait_seconds * (2 ** min(polls, 16)), max(max_seconds, wait_seconds))
+
 class Arguments(Message):
     apiVersion = 'v0'
     Fields = ('values',)
@@ -269,6 +743,7 @@ class ResultSet(Enumerable, Message):
     apiVersion = 'v0'
     Fields = ('values',)
     Metadata = ('next','args',)
+    Incremental = 'values'
     def enumerate(self):
         return [Result(v) for v in self.values]
     def request_next(self, limit=None):
@@ -289,10 +764,18 @@ class Model(Message):
         url = 'create'
         return Request('create', url, {}, args, None)
 
+    def create_many(self, items):
+        url = 'create_many'
+        return Request('create_many', url, {}, {'items': list(items)}, None)
+
     def delete_entry(self, key):
         url = 'delete/{}'.format(key)
         return Request('delete', url, {}, None, None)
 
+    def delete_many(self, keys):
+        url = 'delete_many'
+        return Request('delete_many', url, {}, {'keys': list(keys)}, None)
+
     def set_entry(self, key, args):
         url = 'set/{}'.format(key)
         return Request('set', url, {}, args, None)
@@ -304,8 +787,15 @@ class Model(Message):
     def watch_entry(self, key):
         pass
 
-    def get_where(self, selector, limit=None):
+    def get_where(self, selector, limit=None, columns=False):
+        """ columns asks for rows rather than embedded entries, servers may ignore it """
         query = dict(selector=selector, limit=limit)
+        if columns:
+            query['columns'] = True
+        return Request('list', 'list', query, None, None)
+
+    def explain_where(self, selector):
+        query = dict(selector=selector, explain=True)
         return Request('list', 'list', query, None, None)
 
     def delete_where(self, selector):
@@ -325,16 +815,119 @@ class Entry(Format, Message):
 class EntrySet(Enumerable, Message):
     apiVersion = 'v0'
     Fields = ('items', )
-    Metadata = ('next', 'selector', 'state')
+    Metadata = ('next', 'selector', 'state', 'columns', 'shared')
+    Incremental = 'items'
     def enumerate(self):
-        return [decode_object(i) for i in self.items]
-        # todo - shared metadata
+        if self.columns is None:
+            return [decode_object(i) for i in self.items]
+        return self.entries()
+
+    def entries(self):
+        """ with columns, items are rows of attribute values, and shared is the metadata of every Entry """
+        names, shared = self.columns, self.shared or {}
+        for row in self.items:
+            yield Entry(attributes=dict(zip(names, row)), **shared)
+
     def request_next(self, limit=None):
         if self.next is not None:
             query = dict(selector=self.selector, state=self.state, limit=limit)
+            if self.columns is not None:
+                query['columns'] = True
             return Request('list', self.next, query, None, None)
 
-# Stream - one way out
+class Batch(Message):
+    """ calls is a list of {'path':..., 'params':..., 'args':...}, paths relative to the root """
+    apiVersion = 'v0'
+    Fields = ('calls',)
+    Metadata = ('parallel',)
+
+    def add(self, path, params, args):
+        self.calls.append(dict(path=path, params=params or {}, args=args))
+
+class BatchResult(Message):
+    """ results are embedded messages, in the same order as the calls """
+    apiVersion = 'v0'
+    Fields = ('results',)
+    Metadata = ()
+    Incremental = 'results'
+
+    def enumerate(self):
+        return [decode_object(r) for r in self.results]
+
+class Error(Format, Message):
+    apiVersion = 'v0'
+    Fields = ('status', 'message')
+    Metadata = ()
+
+    def format(self):
+        return "{}: {}".format(self.status, self.message)
+
+class RemoteError(errors.Error):
+    """ an Error the server sent part way through a response, after its status """
+    def __init__(self, error):
+        errors.Error.__init__(self, error.format())
+        self.status = error.status
+        self.message = error.message
+
+class Stream(Enumerable, Message):
+    """
+        values from a generator, sent as they are produced
+
+        on the wire, a Stream is newline delimited json: a header line
+        {"kind": "Stream", ...}, then one embedded Result per value, and
+        an Error if the generator fails part way through. it is always
+        json, whatever codec was negotiated for other responses.
+
+        clients that don't accept STREAM_CONTENT_TYPE get a ResultSet
+    """
+    apiVersion = 'v0'
+    Fields = ('values',)
+    Metadata = ()
+
+    def enumerate(self):
+        return (Result(v) for v in self.values)
+
+    def request_next(self, limit=None):
+        pass
+
+    def embed(self):
+        return ResultSet(list(self.values), None, None).embed()
+
+    def encode_iter(self, accept=None, on_error=None):
+        if not accepts(accept, STREAM_CONTENT_TYPE):
+            return ResultSet(self.values, None, None).encode_iter(accept, on_error)
+        return STREAM_CONTENT_TYPE, self.frames(on_error)
+
+    def frames(self, on_error=None):
+        header = dict(kind=self.kind, apiVersion=self.apiVersion, metadata={})
+        yield json.dumps(header).encode('utf-8') + b'\n'
+        try:
+            for value in self.values:
+                yield json.dumps(Result(value).embed()).encode('utf-8') + b'\n'
+        except Exception as e:
+            (on_error or traceback.print_exc)()
+            yield json.dumps(Error("500 bad", repr(e)).embed()).encode('utf-8') + b'\n'
+
+    @classmethod
+    def from_file(cls, fh):
+        """ reads the header now, and each value as it is iterated, closing fh at the end """
+        header = json.loads(fh.readline())
+        if header.get('kind') != cls.__name__:
+            fh.close()
+            raise Exception("not a stream: {}".format(header.get('kind')))
+
+        def values():
+            try:
+                for line in iter(fh.readline, b''):
+                    if not line.strip():
+                        continue
+                    frame = decode_object(json.loads(line))
+                    if isinstance(frame, Error):
+                        raise RemoteError(frame)
+                    yield frame.value
+            finally:
+                fh.close()
+        return cls(values())
 
 # Channel - two way
 
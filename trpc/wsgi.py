@@ -1,10 +1,18 @@
 
 import threading
+import selectors
+import signal
 import socket
+import os
+import sys
+import queue
+import time
 import traceback
 
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urljoin, urlencode, parse_qsl
-from wsgiref.simple_server import make_server, WSGIRequestHandler
+from wsgiref import simple_server
+from wsgiref.simple_server import make_server, WSGIRequestHandler, ServerHandler
 
 class WSGIServer(threading.Thread):
     class QuietWSGIRequestHandler(WSGIRequestHandler):
@@ -27,6 +35,16 @@ class WSGIServer(threading.Thread):
         while self.running:
             self.server.handle_request()
 
+    def wait(self):
+        """ block until ^C or SIGTERM, which both raise KeyboardInterrupt """
+        def interrupt(signum, frame):
+            raise KeyboardInterrupt()
+        old = signal.signal(signal.SIGTERM, interrupt)
+        try:
+            self.join()
+        finally:
+            signal.signal(signal.SIGTERM, old)
+
     def stop(self):
         self.running =False
         if self.server and self.is_alive():
@@ -38,3 +56,445 @@ class WSGIServer(threading.Thread):
             except IOError:
                 traceback.print_exc()
         self.join(5)
+
+class KeepAliveServerHandler(ServerHandler):
+    """ HTTP/1.1 responses: Content-Length when known, otherwise chunked """
+    http_version = "1.1"
+    chunked = False
+
+    def cleanup_headers(self):
+        ServerHandler.cleanup_headers(self)
+        request_handler = self.request_handler
+        if 'Content-Length' not in self.headers:
+            if request_handler.request_version == 'HTTP/1.1':
+                self.headers['Transfer-Encoding'] = 'chunked'
+            else:
+                request_handler.close_connection = True
+        if request_handler.close_connection:
+            self.headers['Connection'] = 'close'
+
+    def send_headers(self):
+        ServerHandler.send_headers(self)
+        self.chunked = self.headers.get('Transfer-Encoding') == 'chunked'
+
+    def _write(self, data):
+        if self.chunked and data:
+            data = b'%x\r\n%s\r\n' % (len(data), data)
+        ServerHandler._write(self, data)
+
+    def finish_content(self):
+        ServerHandler.finish_content(self)
+        if self.chunked:
+            self.chunked = False
+            ServerHandler._write(self, b'0\r\n\r\n')
+
+    def handle_error(self):
+        self.request_handler.close_connection = True
+        ServerHandler.handle_error(self)
+
+class RequestBody:
+    """ wsgi.input for one request on a persistent connection """
+    def __init__(self, rfile, length):
+        self.rfile = rfile
+        self.remaining = length
+
+    def read(self, size=-1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.rfile.read(size) if size else b''
+        self.remaining -= len(data)
+        return data
+
+    def readline(self, size=-1):
+        if size is None or size < 0 or size > self.remaining:
+            size = self.remaining
+        data = self.rfile.readline(size) if size else b''
+        self.remaining -= len(data)
+        return data
+
+    def readlines(self, hint=-1):
+        return list(iter(self.readline, b''))
+
+    def __iter__(self):
+        return iter(self.readline, b'')
+
+    def drain(self):
+        while self.remaining:
+            if not self.read(65536):
+                return False
+        return True
+
+class KeepAliveRequestHandler(WSGIRequestHandler):
+    """
+        one per connection. unlike socketserver's handlers, the constructor
+        only sets up the connection: the server calls resume() each time a
+        request arrives, and finish() when the connection is closed
+    """
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True # headers and body are written separately
+
+    def __init__(self, request, client_address, server):
+        self.request = request
+        self.client_address = client_address
+        self.server = server
+        self.close_connection = False
+        self.setup()
+
+    def setup(self):
+        self.timeout = self.server.read_timeout
+        WSGIRequestHandler.setup(self)
+
+    def resume(self):
+        """ serve requests while they are buffered, returns True to keep the connection """
+        self.handle_one_request()
+        while not self.close_connection and not self.server.draining:
+            if not self.pending():
+                return True
+            self.handle_one_request()
+        return False
+
+    def pending(self):
+        self.connection.setblocking(False)
+        try:
+            return bool(self.rfile.peek(1))
+        except OSError:
+            return False
+        finally:
+            self.connection.settimeout(self.timeout)
+
+    def handle_one_request(self):
+        try:
+            self.raw_requestline = self.rfile.readline(65537)
+        except OSError:
+            self.close_connection = True
+            return
+        if not self.raw_requestline:
+            self.close_connection = True
+            return
+
+        try:
+            if len(self.raw_requestline) > 65536:
+                self.requestline = ''
+                self.request_version = ''
+                self.command = ''
+                self.send_error(414)
+                return
+
+            if not self.parse_request():
+                return
+
+            if self.headers.get('Transfer-Encoding'):
+                self.send_error(411)
+                return
+
+            environ = self.get_environ()
+            body = RequestBody(self.rfile, int(self.headers.get('Content-Length') or 0))
+            handler = KeepAliveServerHandler(
+                body, self.wfile, self.get_stderr(), environ,
+                multithread=True,
+            )
+            handler.request_handler = self
+            handler.run(self.server.get_app())
+            self.wfile.flush()
+
+            if not body.drain():
+                self.close_connection = True
+        except OSError:
+            self.close_connection = True
+
+class ThreadPoolHTTPServer(simple_server.WSGIServer):
+    """
+        a selector thread accepts connections and watches idle ones, and a
+        bounded pool of worker threads serves requests as they arrive, so an
+        idle keep-alive connection does not hold on to a worker.
+
+        connections idle for longer than read_timeout are closed. past
+        max_connections, new connections wait in the listen backlog.
+    """
+    def __init__(self, address, request_handler, threads=8, backlog=128, read_timeout=30, max_connections=1024):
+        self.request_queue_size = backlog
+        self.threads = threads
+        self.read_timeout = read_timeout
+        self.max_connections = max_connections
+        self.running = False
+        self.draining = False
+        self.stopped = threading.Event()
+        self.stopped.set()
+        self.connections = set()
+        self.connections_lock = threading.Lock()
+        self.parked = queue.SimpleQueue()
+        self.wakeup_r, self.wakeup_w = socket.socketpair()
+        self.executor = ThreadPoolExecutor(threads, thread_name_prefix='trpc-worker')
+        simple_server.WSGIServer.__init__(self, address, request_handler)
+
+    def set_app(self, application):
+        simple_server.WSGIServer.set_app(self, application)
+        jobs = getattr(application, 'jobs', None)
+        if jobs is not None and jobs.executor is None:
+            # calls with a deadline hold a worker and a job thread each, so
+            # the job pool must not be the smaller one, see App.dispatch_with_deadline
+            jobs.max_workers = max(jobs.max_workers or 0, 2 * self.threads)
+
+    def after_fork(self):
+        """ the worker threads and wakeup socket can't be shared with the parent """
+        self.wakeup_r.close()
+        self.wakeup_w.close()
+        self.wakeup_r, self.wakeup_w = socket.socketpair()
+        self.executor = ThreadPoolExecutor(self.threads, thread_name_prefix='trpc-worker')
+
+    def wakeup(self):
+        try:
+            self.wakeup_w.send(b'\0')
+        except OSError:
+            pass
+
+    def serve_forever(self, poll_interval=0.5):
+        self.running = True
+        self.stopped.clear()
+        selector = selectors.DefaultSelector()
+        selector.register(self.wakeup_r, selectors.EVENT_READ)
+        listening = False
+        idle = {}
+        try:
+            while self.running:
+                full = len(self.connections) >= self.max_connections
+                if listening and full:
+                    selector.unregister(self.socket)
+                    listening = False
+                elif not listening and not full:
+                    selector.register(self.socket, selectors.EVENT_READ)
+                    listening = True
+
+                for key, events in selector.select(poll_interval):
+                    if key.fileobj is self.socket:
+                        handler = self.accept()
+                        if handler:
+                            selector.register(handler.connection, selectors.EVENT_READ, handler)
+                            idle[handler] = time.monotonic()
+                    elif key.fileobj is self.wakeup_r:
+                        self.wakeup_r.recv(4096)
+                    else:
+                        selector.unregister(key.fileobj)
+                        del idle[key.data]
+                        self.executor.submit(self.serve_connection, key.data)
+
+                now = time.monotonic()
+                while True:
+                    try:
+                        handler = self.parked.get_nowait()
+                    except queue.Empty:
+                        break
+                    selector.register(handler.connection, selectors.EVENT_READ, handler)
+                    idle[handler] = now
+
+                for handler, since in list(idle.items()):
+                    if now - since > self.read_timeout:
+                        selector.unregister(handler.connection)
+                        del idle[handler]
+                        self.close_connection(handler)
+        finally:
+            for handler in idle:
+                self.close_connection(handler)
+            selector.close()
+            self.stopped.set()
+
+    def shutdown(self):
+        self.running = False
+        self.wakeup()
+        self.stopped.wait()
+
+    def accept(self):
+        try:
+            request, client_address = self.get_request()
+        except OSError:
+            return
+        try:
+            handler = self.RequestHandlerClass(request, client_address, self)
+        except Exception:
+            self.handle_error(request, client_address)
+            self.shutdown_request(request)
+            return
+        with self.connections_lock:
+            self.connections.add(handler)
+        return handler
+
+    def serve_connection(self, handler):
+        try:
+            keep = handler.resume()
+        except Exception:
+            self.handle_error(handler.request, handler.client_address)
+            keep = False
+        if keep and self.running and not self.draining:
+            self.parked.put(handler)
+            self.wakeup()
+        else:
+            self.close_connection(handler)
+
+    def close_connection(self, handler):
+        with self.connections_lock:
+            self.connections.discard(handler)
+        try:
+            handler.finish()
+        except OSError:
+            pass
+        self.shutdown_request(handler.request)
+        self.wakeup()
+
+    def drain(self):
+        """ stop accepting, finish in-flight requests, close the rest """
+        self.draining = True
+        self.shutdown()
+        self.server_close()
+        self.executor.shutdown(wait=True)
+        while True:
+            try:
+                handler = self.parked.get_nowait()
+            except queue.Empty:
+                break
+            self.close_connection(handler)
+        self.wakeup_r.close()
+        self.wakeup_w.close()
+
+class ThreadPoolWSGIServer(WSGIServer):
+    def __init__(self, app, host="", port=0, threads=8, backlog=128, read_timeout=30, max_connections=1024, request_handler=KeepAliveRequestHandler):
+        threading.Thread.__init__(self)
+        self.daemon=True
+        self.running = True
+        self.server = ThreadPoolHTTPServer((host, port), request_handler,
+            threads=threads, backlog=backlog, read_timeout=read_timeout, max_connections=max_connections)
+        self.server.set_app(app)
+
+    def run(self):
+        self.running = True
+        self.server.serve_forever(poll_interval=0.5)
+
+    def stop(self):
+        self.running = False
+        self.server.drain()
+        self.join(5)
+
+class PreforkServer:
+    """
+        binds once, then forks workers that all accept on the inherited socket.
+
+        the parent restarts workers that exit, on SIGHUP it restarts all of
+        them, and on SIGINT or SIGTERM it stops them and returns from wait().
+        each worker runs a ThreadPoolHTTPServer when threads is set, or a
+        single threaded server otherwise, and drains on SIGTERM.
+    """
+    Signals = (signal.SIGINT, signal.SIGTERM, signal.SIGHUP)
+
+    def __init__(self, app, host="", port=0, workers=2, threads=None, backlog=128, read_timeout=30, request_handler=None, stop_timeout=10):
+        self.workers = workers
+        self.stop_timeout = stop_timeout
+        self.pids = {}
+        self.running = False
+        self.mask = None # the signal mask before wait(), restored in workers
+        if threads:
+            self.server = ThreadPoolHTTPServer((host, port), request_handler or KeepAliveRequestHandler,
+                threads=threads, backlog=backlog, read_timeout=read_timeout)
+        else:
+            self.server = make_server(host, port, app,
+                handler_class=request_handler or WSGIServer.QuietWSGIRequestHandler)
+        self.server.set_app(app)
+        if hasattr(app, 'processes'):
+            app.processes = workers # see App.single_process
+
+    @property
+    def url(self):
+        return u'http://%s:%d/'%(self.server.server_name, self.server.server_port)
+
+    def start(self):
+        self.running = True
+        self.mask = signal.pthread_sigmask(signal.SIG_BLOCK, [])
+        for n in range(self.workers):
+            self.spawn()
+
+    def spawn(self):
+        pid = os.fork()
+        if pid:
+            self.pids[pid] = time.monotonic()
+            return pid
+        code = 0
+        try:
+            # wait() blocks SIGCHLD too, which workers and their subprocesses shouldn't inherit
+            if self.mask is not None:
+                signal.pthread_sigmask(signal.SIG_SETMASK, self.mask)
+            self.run_worker()
+        except BaseException:
+            traceback.print_exc()
+            code = 1
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(code)
+
+    def run_worker(self):
+        signal.pthread_sigmask(signal.SIG_BLOCK, self.Signals)
+        server = self.server
+        server.socket.setblocking(False) # other workers may win the accept
+        if hasattr(server, 'after_fork'):
+            server.after_fork()
+
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        signal.sigwait(self.Signals)
+
+        if hasattr(server, 'drain'):
+            server.drain()
+        else:
+            server.shutdown()
+            server.server_close()
+
+    def reap(self):
+        """ collect exited workers, returns how many of them exited early """
+        early = 0
+        while self.pids:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if not pid:
+                break
+            started = self.pids.pop(pid, None)
+            if started is not None and time.monotonic() - started < 1:
+                early += 1
+        return early
+
+    def wait(self):
+        """ supervise the workers until SIGINT or SIGTERM """
+        signals = set(self.Signals)
+        signals.add(signal.SIGCHLD)
+        old_mask = signal.pthread_sigmask(signal.SIG_BLOCK, signals)
+        try:
+            signum = signal.SIGCHLD
+            while True:
+                if signum in (signal.SIGINT, signal.SIGTERM):
+                    return
+                elif signum == signal.SIGHUP:
+                    self.kill(signal.SIGTERM)
+                elif signum == signal.SIGCHLD:
+                    if self.reap():
+                        time.sleep(1) # crashing on startup, don't fork bomb
+                    while self.running and len(self.pids) < self.workers:
+                        self.spawn()
+                signum = signal.sigwait(signals)
+        finally:
+            signal.pthread_sigmask(signal.SIG_SETMASK, old_mask)
+
+    def kill(self, signum):
+        for pid in list(self.pids):
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def stop(self):
+        self.running = False
+        self.kill(signal.SIGTERM)
+        deadline = time.monotonic() + self.stop_timeout
+        while self.pids and time.monotonic() < deadline:
+            self.reap()
+            time.sleep(0.05)
+        self.kill(signal.SIGKILL)
+        while self.pids:
+            pid, status = os.waitpid(-1, 0)
+            self.pids.pop(pid, None)
+        self.server.server_close()